@@ -53,6 +53,8 @@ if 'READTHEDOCS' not in os.environ:
         cluster_on_extra_high_voltage,
         kmean_clustering)
 
+    from etrago.tools.backend import LocalBackend
+
     from etrago.tools.io import (
         NetworkScenario,
         results_to_oedb,
@@ -91,7 +93,8 @@ if 'READTHEDOCS' not in os.environ:
         get_args_setting,
         set_branch_capacity,
         iterate_lopf,
-        set_random_noise)
+        set_random_noise,
+        compact_network)
 
     from etrago.tools.constraints import(
         Constraints)
@@ -110,6 +113,7 @@ if 'READTHEDOCS' not in os.environ:
 args = {
     # Setup and Configuration:
     'db': 'oedb',  # database session
+    'local_db': False,  # False or /path/tofile of a dumped scenario
     'gridversion': 'v0.4.6',  # None for model_draft or Version number
     'method': 'lopf',  # lopf or pf
     'pf_post_lopf': False,  # perform a pf after a lopf simulation
@@ -120,12 +124,15 @@ args = {
                        'logFile': 'solver.log'},  # {} for default options
     'model_formulation': 'kirchhoff', # angles or kirchhoff
     'scn_name': 'eGo 100',  # a scenario: Status Quo, NEP 2035, eGo 100
+    'network_cache': False,  # False or /path/tofolder of local network cache
+    'fetch_workers': 1,  # number of tables queried concurrently from the oedb
     # Scenario variations:
     'scn_extension': None,  # None or array of extension scenarios
     'scn_decommissioning': None,  # None or decommissioning scenario
     # Export options:
     'lpfile': False,  # save pyomo's lp file: False or /path/tofolder
     'csv_export': False,  # save results as csv: False or /path/tofolder
+    'parquet_export': False,  # save results as parquet: False or /path
     'db_export': False,  # export the results back to the oedb
     # Settings:
     'extendable': ['network', 'storage'],  # Array of components to optimize
@@ -136,8 +143,11 @@ args = {
     # Clustering:
     'network_clustering_kmeans': 30,  # False or the value k for clustering
     'load_cluster': False,  # False or predefined busmap for k-means
+    'cluster_by_country': False,  # k-means of each country separately
     'network_clustering_ehv': False,  # clustering of HV buses to EHV buses.
     'disaggregation': None,  # None, 'mini' or 'uniform'
+    'disaggregation_processes': 1,  # processes of the disaggregation
+    'solver_threads': None,  # solver threads per partial network or None
     'snapshot_clustering': False,  # False or the number of 'periods'
     # Simplifications:
     'parallelisation': False,  # run snapshots parallely.
@@ -145,6 +155,7 @@ args = {
     'line_grouping': False,  # group lines parallel lines
     'branch_capacity_factor': {'HV': 0.5, 'eHV': 0.7},  # p.u. branch derating
     'load_shedding': False,  # meet the demand at value of loss load cost
+    'compact_network': False,  # float32 timeseries, geometries kept on disk
     'foreign_lines': {'carrier': 'AC', 'capacity': 'osmTGmod'},
     'comments': None}
 
@@ -163,6 +174,13 @@ def etrago(args):
         ``'oedb'``,
         Name of Database session setting stored in *config.ini* of *.egoio*
 
+    local_db : bool or str
+        False,
+        State if you want to read all data from a local SQLite or DuckDB
+        file instead of the oedb: False or '/path/tofile'. The file is
+        created once by :func:`etrago.tools.backend.dump_scenario`.
+        Results can not be exported to the oedb in this case.
+
     gridversion : NoneType or str
         ``'v0.2.11'``,
         Name of the data version number of oedb: state ``'None'`` for
@@ -209,6 +227,21 @@ def etrago(args):
         Schleswig-Holstein by adding the acronym SH to the scenario
         name (e.g. 'SH Status Quo').
 
+    network_cache : bool or str
+        False,
+        State if and where you want to cache the network queried from the
+        oedb: False or '/path/tofolder'. Repeated runs with the same
+        scenario, gridversion, method and snapshots load the network from
+        this folder instead of the database. Busmaps of the ehv clustering
+        and results of the k-mean clustering are cached there as well,
+        keyed by the grid and the clustering settings.
+
+    fetch_workers : int
+        1,
+        Number of tables queried concurrently from the oedb while the
+        network is built. Each query uses its own connection of the
+        engine's pool. 1 queries all tables one after another.
+
    scn_extension : NoneType or list
        None,
        Choose extension-scenarios which will be added to the existing
@@ -247,6 +280,12 @@ def etrago(args):
         State if and where you want to save results as csv files.Options:
         False or '/path/tofolder'.
 
+    parquet_export : obj
+        False,
+        State if and where you want to save results as compressed parquet
+        files, which can be read with :mod:`etrago.tools.results`. Options:
+        False or '/path/tofolder'.
+
     db_export : bool
         False,
         State if you want to export the results of your calculation
@@ -337,12 +376,31 @@ def etrago(args):
         state if you want to load cluster coordinates from a previous run:
         False or /path/tofile (filename similar to ./cluster_coord_k_n_result).
 
+    cluster_by_country : bool
+        False,
+        State if the k-means clustering is applied to each country
+        separately. The k clusters are distributed among the countries
+        according to their weighting and the countries are clustered in
+        parallel. Lines between countries are kept.
+
     network_clustering_ehv : bool
         False,
         Choose if you want to cluster the full HV/EHV dataset down to only the
         EHV buses. In that case, all HV buses are assigned to their closest EHV
         sub-station, taking into account the shortest distance on power lines.
 
+    disaggregation_processes : int or None
+        1,
+        Number of processes solving the partial networks of the
+        disaggregation in parallel. 1 solves them one after another, None
+        uses all cores.
+
+    solver_threads : int or None
+        None,
+        Number of threads of the solver of each partial network of the
+        disaggregation. None keeps the solver's default, with several
+        processes e.g. 1 avoids oversubscribing the cores.
+
     snapshot_clustering : bool or int
         False,
         State if you want to cluster the snapshots and run the optimization
@@ -373,6 +431,14 @@ def etrago(args):
         bus and meets the demand when regular
         generators cannot do so.
 
+    compact_network : bool
+        False,
+        State if the memory used by the network should be reduced after it
+        is prepared and clustered: time series are stored as float32 where this is
+        lossless up to 1e-6, repetitive text columns become categoricals and
+        geometries are moved to a temporary directory. They are restored
+        before the results are exported to the oedb.
+
     foreign_lines : dict
         {'carrier':'AC', 'capacity': 'osmTGmod}'
         Choose transmission technology and capacity of foreign lines:
@@ -388,9 +454,17 @@ def etrago(args):
         eTraGo result network based on `PyPSA network
         <https://www.pypsa.org/doc/components.html#network>`_
     """
-    conn = db.connection(section=args['db'])
-    Session = sessionmaker(bind=conn)
-    session = Session()
+    if args.get('local_db'):
+        if args['db_export']:
+            raise Exception('Results can not be exported to the oedb when '
+                            'using a local database.')
+        backend = LocalBackend(args['local_db'])
+        session = None
+    else:
+        backend = None
+        conn = db.connection(section=args['db'])
+        Session = sessionmaker(bind=conn)
+        session = Session()
 
     # additional arguments cfgpath, version, prefix
     if args['gridversion'] is None:
@@ -404,7 +478,10 @@ def etrago(args):
                                method=args['method'],
                                start_snapshot=args['start_snapshot'],
                                end_snapshot=args['end_snapshot'],
-                               scn_name=args['scn_name'])
+                               scn_name=args['scn_name'],
+                               cache=args.get('network_cache') or None,
+                               max_workers=args.get('fetch_workers', 1),
+                               backend=backend)
 
     network = scenario.build_network()
 
@@ -412,7 +489,7 @@ def etrago(args):
     network = add_coordinates(network)
 
     # Set countrytags of buses, lines, links and transformers
-    network = geolocation_buses(network, session)
+    network = geolocation_buses(network, session, backend)
 
     # Set q_sets of foreign loads
     network = set_q_foreign_loads(network, cos_phi=1)
@@ -420,7 +497,7 @@ def etrago(args):
     # Change transmission technology and/or capacity of foreign lines
     if args['foreign_lines']['carrier'] == 'DC':
         foreign_links(network)
-        network = geolocation_buses(network, session)
+        network = geolocation_buses(network, session, backend)
 
     if args['foreign_lines']['capacity'] != 'osmTGmod':
         crossborder_capacity(
@@ -462,8 +539,9 @@ def etrago(args):
                     version=args['gridversion'],
                     scn_extension=args['scn_extension'][i],
                     start_snapshot=args['start_snapshot'],
-                    end_snapshot=args['end_snapshot'])
-        network = geolocation_buses(network, session)
+                    end_snapshot=args['end_snapshot'],
+                    backend=backend)
+        network = geolocation_buses(network, session, backend)
 
     # Add missing lines in Munich and Stuttgart
     network = add_missing_components(network)
@@ -481,7 +559,8 @@ def etrago(args):
         network = decommissioning(
             network,
             session,
-            args)
+            args,
+            backend=backend)
 
     # investive optimization strategies
     if args['extendable'] != []:
@@ -506,9 +585,15 @@ def etrago(args):
                         args['scn_name'] if args['scn_extension']==None
                         else args['scn_name']+'_ext_'+'_'.join(
                                 args['scn_extension'])),
-                version=args['gridversion'])
+                version=args['gridversion'],
+                backend=backend,
+                cache=args.get('network_cache') or None,
+                base_scn_name=(
+                        args['scn_name'] if args['scn_extension'] else None))
         network = cluster_on_extra_high_voltage(
             network, busmap, with_time=True)
+        # country tags are lost by the aggregation of the buses
+        network = geolocation_buses(network, session, backend)
 
     # k-mean clustering
     if not args['network_clustering_kmeans'] == False:
@@ -524,11 +609,14 @@ def etrago(args):
                 n_init=10,
                 max_iter=100,
                 tol=1e-6,
-                n_jobs=-1)
+                n_jobs=-1,
+                cache=args.get('network_cache') or None,
+                partition=('country_code' if args.get('cluster_by_country')
+                           else None))
         disaggregated_network = (
                 network.copy() if args.get('disaggregation') else None)
         network = clustering.network.copy()
-        geolocation_buses(network, session)
+        geolocation_buses(network, session, backend)
 
     # skip snapshots
     if args['skip_snapshots']:
@@ -549,6 +637,11 @@ def etrago(args):
     if 'network_preselection' in args['extendable']:
         extension_preselection(network, args, 'snapshot_clustering', 2)
 
+    # after all clusterings, which build new networks without the stored
+    # geometries
+    if args.get('compact_network'):
+        compact_network(network)
+
     # parallisation
     if args['parallelisation']:
         parallelisation(
@@ -595,12 +688,17 @@ def etrago(args):
                         disaggregated_network,
                         network,
                         clustering,
-                        skip=skip)
+                        skip=skip,
+                        processes=args.get('disaggregation_processes', 1),
+                        solver_threads=args.get('solver_threads'))
             elif disagg == 'uniform':
-                disaggregation = UniformDisaggregation(disaggregated_network,
-                                                       network,
-                                                       clustering,
-                                                       skip=skip)
+                disaggregation = UniformDisaggregation(
+                        disaggregated_network,
+                        network,
+                        clustering,
+                        skip=skip,
+                        processes=args.get('disaggregation_processes', 1),
+                        solver_threads=args.get('solver_threads'))
 
             else:
                 raise Exception('Invalid disaggregation command: ' + disagg)
@@ -626,6 +724,9 @@ def etrago(args):
         username = str(conn.url).split('//')[1].split(':')[0]
         args['user_name'] = username
 
+        if hasattr(network, 'geometries'):
+            network.geometries.restore(network)
+
         results_to_oedb(
             session,
             network,
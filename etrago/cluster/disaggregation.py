@@ -2,23 +2,36 @@ from functools import reduce
 from itertools import count, product
 from operator import methodcaller as mc, mul as multiply
 import cProfile
+import multiprocessing as mp
 import random
 import string
 import time
 
+import numpy as np
 import pandas as pd
 from pyomo.environ import Constraint
 from pypsa import Network
+from scipy.sparse import csr_matrix
 
 
 class Disaggregation:
+    transfer_bustypes = ['loads', 'generators', 'stores', 'storage_units',
+                         'shunt_impedances']
+    transfer_series = None
+    # series computed by the optimization, all other series are inputs
+    result_series = {'p', 'q', 'state_of_charge', 'spill', 'e', 'status'}
+
     def __init__(self, original_network, clustered_network, clustering,
-                 skip=()):
+                 skip=(), processes=1, solver_threads=None):
         """
         :param original_network: Initial (unclustered) network structure
         :param clustered_network: Clustered network used for the optimization
         :param clustering: The clustering object as returned by
         `pypsa.networkclustering.get_clustering_from_busmap`
+        :param processes: Number of processes solving partial networks in
+        parallel, 1 solves them one after another and None uses all cores
+        :param solver_threads: Number of threads of the solver of each
+        partial network, None keeps the solver's default
         """
         self.original_network = original_network
         self.clustered_network = clustered_network
@@ -32,6 +45,12 @@ class Disaggregation:
 
         self.idx_prefix = '_'
 
+        self._groups = None
+
+        self.processes = processes
+        self.solver_options = ({} if solver_threads is None
+                               else {'threads': solver_threads})
+
     def add_constraints(self, cluster, extra_functionality=None):
         """
         Dummy function that allows the extension of `extra_functionalites` by
@@ -52,6 +71,68 @@ class Disaggregation:
 
 
 
+    def groups(self):
+        """
+        Positions of the buses and components of each cluster.
+
+        Every bus gets the integer code of its cluster, and every component
+        is grouped by the codes of its buses once, so that all partial
+        networks can be constructed from these groups.
+
+        :return: Dictionary with the sorted cluster names under `'clusters'`,
+        the codes of the external clusters adjacent to each cluster under
+        `'neighbours'` and, for each component type, dictionaries from
+        cluster codes to row positions. Lines, links and transformers are
+        grouped if they reside entirely inside a cluster. Buses and one-port
+        components of the clustered network are grouped under
+        `'clustered_' + type`.
+        """
+        if self._groups is not None:
+            return self._groups
+
+        busmap = self.clustering.busmap
+        clusters = pd.Index(sorted(set(busmap.values)))
+        codes = pd.Series(clusters.get_indexer(busmap.values),
+                          index=busmap.index)
+
+        def code(buses):
+            return codes.reindex(buses).fillna(-1).astype(int).values
+
+        def positions(keys):
+            return pd.Series(np.arange(len(keys))).groupby(keys).indices
+
+        groups = {'clusters': clusters}
+        groups['buses'] = positions(
+                code(self.original_network.buses.index))
+        groups['clustered_buses'] = positions(
+                clusters.get_indexer(self.clustered_network.buses.index))
+
+        neighbours = []
+        for line_type in ['lines', 'links', 'transformers']:
+            df = getattr(self.original_network, line_type)
+            c0, c1 = code(df.bus0), code(df.bus1)
+            internal = c0 == c1
+            groups[line_type] = positions(np.where(internal, c0, -1))
+            # clusters connected by lines leaving them
+            external = ~internal & (c0 >= 0) & (c1 >= 0)
+            neighbours.append(np.stack((c1[external], c0[external])))
+            neighbours.append(np.stack((c0[external], c1[external])))
+        neighbours = pd.DataFrame(np.concatenate(neighbours, axis=1).T,
+                                  columns=['cluster', 'external'])
+        groups['neighbours'] = {
+                c: np.unique(df.external.values)
+                for c, df in neighbours.groupby('cluster')}
+
+        for bustype in ['loads', 'generators', 'stores', 'storage_units',
+                        'shunt_impedances']:
+            groups[bustype] = positions(
+                    code(getattr(self.original_network, bustype).bus))
+            groups['clustered_' + bustype] = positions(clusters.get_indexer(
+                    getattr(self.clustered_network, bustype).bus))
+
+        self._groups = groups
+        return groups
+
     def construct_partial_network(self, cluster, scenario):
         """
         Compute the partial network that has been merged into a single cluster.
@@ -64,17 +145,22 @@ class Disaggregation:
         :return: Tuple of (partial_network, external_buses) where
         `partial_network` is the result of the partial decomposition
         and `external_buses` represent clusters adjacent to `cluster` that may
-        be influenced by calculations done on the partial network.
+        be influenced by calculations done on the partial network. It is a
+        `pd.DataFrame` with the prefixed names of these buses in its column
+        `'bus'`, one row per adjacent cluster.
         """
 
-        #Create an empty network
-        partial_network = Network()
+        groups = self.groups()
+        code = groups['clusters'].get_loc(cluster)
+        neighbours = groups['neighbours'].get(code, [])
 
-        # find all lines that have at least one bus inside the cluster
-        busflags = (self.buses['cluster'] == cluster)
+        def rows(df, group, codes=(code,)):
+            none = np.array([], dtype=int)
+            return df.iloc[np.sort(np.concatenate(
+                [none] + [group.get(c, none) for c in codes]))]
 
-        def is_bus_in_cluster(conn):
-            return busflags[conn]
+        #Create an empty network
+        partial_network = Network()
 
         # Copy configurations to new network
         partial_network.snapshots = self.original_network.snapshots
@@ -82,17 +168,12 @@ class Disaggregation:
                                                    .snapshot_weightings)
         partial_network.carriers = self.original_network.carriers
 
-        # Collect all connectors that have some node inside the cluster
-
-        external_buses = pd.DataFrame()
-
         line_types = ['lines', 'links', 'transformers']
         for line_type in line_types:
             # Copy all lines that reside entirely inside the cluster ...
             setattr(partial_network, line_type,
-                    filter_internal_connector(
-                        getattr(self.original_network, line_type),
-                        is_bus_in_cluster))
+                    rows(getattr(self.original_network, line_type),
+                         groups[line_type]))
 
             # ... and their time series
             # TODO: These are all time series, not just the ones from lines
@@ -101,52 +182,20 @@ class Disaggregation:
             setattr(partial_network, line_type + '_t',
                     getattr(self.original_network, line_type + '_t'))
 
-            # Copy all lines whose `bus0` lies within the cluster
-            left_external_connectors = filter_left_external_connector(
-                getattr(self.original_network, line_type),
-                is_bus_in_cluster)
-
-            if not left_external_connectors.empty:
-                f = lambda x: self.idx_prefix + self.clustering.busmap.loc[x]
-                ca_option = pd.get_option('mode.chained_assignment')
-                pd.set_option('mode.chained_assignment', None)
-                left_external_connectors.loc[:, 'bus0'] = (
-                        left_external_connectors.loc[:, 'bus0'].apply(f))
-                pd.set_option('mode.chained_assignment', ca_option)
-                external_buses = pd.concat((external_buses,
-                                            left_external_connectors.bus0))
-
-            # Copy all lines whose `bus1` lies within the cluster
-            right_external_connectors = filter_right_external_connector(
-                getattr(self.original_network, line_type),
-                is_bus_in_cluster)
-            if not right_external_connectors.empty:
-                f = lambda x: self.idx_prefix + self.clustering.busmap.loc[x]
-                ca_option = pd.get_option('mode.chained_assignment')
-                pd.set_option('mode.chained_assignment', None)
-                right_external_connectors.loc[:, 'bus1'] = (
-                        right_external_connectors.loc[:, 'bus1'].apply(f))
-                pd.set_option('mode.chained_assignment', ca_option)
-                external_buses = pd.concat((external_buses,
-                                            right_external_connectors.bus1))
-
-        # Collect all buses that are contained in or somehow connected to the
-        # cluster
-
-        buses_in_lines = self.buses[busflags].index
+        # Collect all clusters that share some line with the cluster
+        external_buses = pd.DataFrame(
+                {'bus': self.idx_prefix + groups['clusters'][neighbours]})
 
         bus_types = ['loads', 'generators', 'stores', 'storage_units',
                      'shunt_impedances']
 
         # Copy all values that are part of the cluster
-        partial_network.buses = self.original_network.buses[
-            self.original_network.buses.index.isin(buses_in_lines)]
+        partial_network.buses = rows(self.original_network.buses,
+                                     groups['buses'])
 
         # Collect all buses that are external, but connected to the cluster ...
-        externals_to_insert = self.clustered_network.buses[
-            self.clustered_network.buses.index.isin(
-                map(lambda x: x[0][len(self.idx_prefix):],
-                    external_buses.values))]
+        externals_to_insert = rows(self.clustered_network.buses,
+                                   groups['clustered_buses'], neighbours)
 
         # ... prefix them to avoid name clashes with buses from the original
         # network ...
@@ -160,23 +209,18 @@ class Disaggregation:
         # TODO: Rename `bustype` to on_bus_type
         for bustype in bus_types:
             # Copy loads, generators, ... from original network to network copy
-            setattr(partial_network, bustype,
-                    filter_buses(getattr(self.original_network, bustype),
-                                 buses_in_lines))
-
-            # Collect on-bus components from external, connected clusters
-            buses_to_insert = filter_buses(
-                getattr(self.clustered_network, bustype),
-                map(lambda x: x[0][len(self.idx_prefix):],
-                    external_buses.values))
+            # and collect on-bus components from external, connected clusters
+            buses_to_insert = rows(
+                    getattr(self.clustered_network, bustype),
+                    groups['clustered_' + bustype], neighbours)
 
             # Prefix their external bindings
-            buses_to_insert.loc[:, 'bus'] = (
-                    self.idx_prefix +
-                    buses_to_insert.loc[:, 'bus'])
+            buses_to_insert = buses_to_insert.assign(
+                    bus=self.idx_prefix + buses_to_insert.bus)
 
             setattr(partial_network, bustype,
-                    getattr(partial_network, bustype).append(buses_to_insert))
+                    rows(getattr(self.original_network, bustype),
+                         groups[bustype]).append(buses_to_insert))
 
             # Also copy their time series
             setattr(partial_network,
@@ -226,35 +270,158 @@ class Disaggregation:
             index=sorted(clusters),
             columns=["decompose", "spread", "transfer"])}
         profile = cProfile.Profile()
-        for i, cluster in enumerate(sorted(clusters)):
-            print('---')
-            print('Decompose cluster %s (%d/%d)' % (cluster, i+1, n))
-            profile.enable()
-            t = time.time()
-            partial_network, externals = self.construct_partial_network(
-                    cluster,
-                    scenario)
-            profile.disable()
-            self.stats['clusters'].loc[cluster, 'decompose'] = time.time() - t
-            print('Decomposed in ',
-                  self.stats['clusters'].loc[cluster, 'decompose'])
-            t = time.time()
-            profile.enable()
-            self.solve_partial_network(cluster, partial_network, scenario,
-                                       solver)
-            profile.disable()
-            self.stats['clusters'].loc[cluster, 'spread'] = time.time() - t
-            print('Result distributed in ',
-                  self.stats['clusters'].loc[cluster, 'spread'])
-            profile.enable()
-            t = time.time()
-            self.transfer_results(partial_network, externals)
-            profile.disable()
-            self.stats['clusters'].loc[cluster, 'transfer'] = time.time() - t
-            print('Results transferred in ',
-                  self.stats['clusters'].loc[cluster, 'transfer'])
-
+        self.allocate_results()
+        if self.processes != 1:
+            self.solve_parallel(sorted(clusters), scenario, solver)
+        else:
+            for i, cluster in enumerate(sorted(clusters)):
+                print('---')
+                print('Decompose cluster %s (%d/%d)' % (cluster, i+1, n))
+                profile.enable()
+                t = time.time()
+                partial_network, externals = (
+                        self.construct_partial_network(cluster, scenario))
+                profile.disable()
+                self.stats['clusters'].loc[cluster, 'decompose'] = (
+                        time.time() - t)
+                print('Decomposed in ',
+                      self.stats['clusters'].loc[cluster, 'decompose'])
+                t = time.time()
+                profile.enable()
+                self.solve_partial_network(cluster, partial_network,
+                                           scenario, solver)
+                profile.disable()
+                self.stats['clusters'].loc[cluster, 'spread'] = (
+                        time.time() - t)
+                print('Result distributed in ',
+                      self.stats['clusters'].loc[cluster, 'spread'])
+                profile.enable()
+                t = time.time()
+                self.transfer_results(partial_network, externals)
+                profile.disable()
+                self.stats['clusters'].loc[cluster, 'transfer'] = (
+                        time.time() - t)
+                print('Results transferred in ',
+                      self.stats['clusters'].loc[cluster, 'transfer'])
+
+        self.write_results()
+        self.results = None
         profile.enable()
+        self.check()
+        profile.disable()
+
+        # profile.print_stats(sort='cumtime')
+
+    def solve_parallel(self, clusters, scenario, solver):
+        """
+        Decompose and solve the clusters in a pool of `self.processes`
+        processes. The results are merged into `original_network` in the
+        order of `clusters`, independent of the order in which the
+        processes finish.
+
+        :param clusters: Indices of the clusters to disaggregate
+        :param scenario:
+        :param solver: Solver that may be used to optimize partial networks
+        """
+        # group the components once, before the processes are forked
+        self.groups()
+        data = (self, scenario, solver)
+        try:
+            context = mp.get_context('fork')
+            _init_disaggregation(data)
+            pool = context.Pool(self.processes)
+        except ValueError:
+            pool = mp.Pool(self.processes, initializer=_init_disaggregation,
+                           initargs=(data,))
+
+        n = len(clusters)
+        try:
+            for i, (cluster, (results, decompose, spread)) in enumerate(
+                    zip(clusters, pool.imap(_solve_cluster, clusters))):
+                print('---')
+                print('Disaggregated cluster %s (%d/%d)' % (cluster, i+1, n))
+                self.stats['clusters'].loc[cluster, 'decompose'] = decompose
+                self.stats['clusters'].loc[cluster, 'spread'] = spread
+                t = time.time()
+                self.merge_results(results)
+                self.stats['clusters'].loc[cluster, 'transfer'] = (
+                        time.time() - t)
+        finally:
+            pool.close()
+            pool.join()
+            _init_disaggregation(None)
+
+    def solve_cluster(self, cluster, scenario, solver):
+        """
+        Decompose and solve a single cluster, as done by the processes of
+        `solve_parallel`.
+
+        :param cluster: Index of the cluster to disaggregate
+        :return: Tuple of the results of the cluster as returned by
+        `cluster_results` and the times needed to decompose and to solve
+        """
+        t = time.time()
+        partial_network, externals = self.construct_partial_network(
+                cluster,
+                scenario)
+        decompose = time.time() - t
+        t = time.time()
+        self.solve_partial_network(cluster, partial_network, scenario,
+                                   solver)
+        spread = time.time() - t
+        self.transfer_results(partial_network, externals)
+        return self.cluster_results(cluster), decompose, spread
+
+    def cluster_results(self, cluster):
+        """
+        Collect `'p_nom_opt'` and the transferred time series of all
+        components of `original_network` inside `cluster`.
+
+        :param cluster: Index of the cluster
+        :return: Dictionary of (static, series) tuples by bustype
+        """
+        buses = self.buses.index[self.buses['cluster'] == cluster]
+        results = {}
+        components = {}
+        for bustype in self.transfer_bustypes:
+            df = getattr(self.original_network, bustype)
+            components[bustype] = df.index[df.bus.isin(buses)]
+            static = (df.loc[components[bustype], ['p_nom_opt']]
+                      if 'p_nom_opt' in df.columns else None)
+            results[bustype] = (static, {})
+        for (bustype, key), (values, columns, filled) in self.results.items():
+            series = results[bustype][1]
+            cols = columns.get_indexer(components[bustype])
+            cols = cols[cols >= 0]
+            cols = cols[filled[cols]]
+            if len(cols):
+                series[key] = pd.DataFrame(
+                        values[:, cols],
+                        index=self.original_network.snapshots,
+                        columns=columns[cols])
+        return results
+
+    def merge_results(self, results):
+        """
+        Write results as returned by `cluster_results` to
+        `original_network`.
+        """
+        for bustype, (static, series) in results.items():
+            if static is not None:
+                getattr(self.original_network, bustype).loc[
+                        static.index, 'p_nom_opt'] = static['p_nom_opt']
+            for key, df in series.items():
+                values, columns, filled = self.results[bustype, key]
+                cols = columns.get_indexer(df.columns)
+                values[:, cols] = df.values
+                filled[cols] = True
+                self.written.add((bustype, key))
+
+    def check(self):
+        """
+        Print the differences between the sums of the clustered and the
+        disaggregated results.
+        """
         t = time.time()
         print('---')
         fs = (mc("sum"), mc("sum"))
@@ -277,32 +444,100 @@ class Disaggregation:
                     reduce(lambda x, f: f(x), ts[s], cnb[s])
                     -
                     reduce(lambda x, f: f(x), ts[s], onb[s])))
-        profile.disable()
         self.stats['check'] = time.time() - t
         print('Checks computed in ', self.stats['check'])
 
-        # profile.print_stats(sort='cumtime')
-
-    def transfer_results(self, partial_network, externals,
-                         bustypes=['loads', 'generators', 'stores',
-                                   'storage_units', 'shunt_impedances'],
-                         series=None):
-        for bustype in bustypes:
+    def allocate_results(self):
+        """
+        Preallocate one array for each transferred series of
+        `original_network`, covering all snapshots. Arrays of the series in
+        `result_series` cover all components of their bustype, arrays of
+        input series only their existing columns. `transfer_results` writes
+        into these arrays and `write_results` copies them back to
+        `original_network`.
+        """
+        self.results = {}
+        self.result_dtypes = {}
+        self.written = set()
+        for bustype in self.transfer_bustypes:
             orig_buses = getattr(self.original_network, bustype + '_t')
-            part_buses = getattr(partial_network, bustype + '_t')
-            for key in (orig_buses.keys()
-                    if series is None
-                    else (k for k in orig_buses.keys()
-                            if k in series.get(bustype, {}))):
-                for snap in partial_network.snapshots:
-                    orig_buses[key].loc[snap].update(part_buses[key].loc[snap])
-
+            index = getattr(self.original_network, bustype).index
+            for key in orig_buses.keys():
+                if (self.transfer_series is not None and
+                        key not in self.transfer_series.get(bustype, {})):
+                    continue
+                columns = orig_buses[key].columns
+                if key in self.result_series:
+                    columns = columns.append(index.difference(columns))
+                values = np.array(orig_buses[key].reindex(
+                        index=self.original_network.snapshots,
+                        columns=columns).values)
+                # columns are only written back if they existed or got
+                # results
+                filled = columns.isin(orig_buses[key].columns)
+                self.results[bustype, key] = (values, columns, filled)
+                self.result_dtypes[bustype, key] = orig_buses[key].dtypes
+
+    def write_results(self):
+        """
+        Replace the series of `original_network` that got results by the
+        arrays of `allocate_results`. Existing columns keep their dtype
+        unless they contain missing values.
+        """
+        for (bustype, key), (values, columns, filled) in self.results.items():
+            if (bustype, key) not in self.written:
+                continue
+            df = pd.DataFrame(values[:, filled],
+                              index=self.original_network.snapshots,
+                              columns=columns[filled])
+            dtypes = self.result_dtypes[bustype, key]
+            df = df.astype({col: dtype for col, dtype in dtypes.items()
+                            if dtype != df[col].dtype and
+                            not df[col].isnull().any()})
+            getattr(self.original_network, bustype + '_t')[key] = df
+
+    def transfer_results(self, partial_network, externals, bustypes=None,
+                         series=None):
+        """
+        Copy the time series of the original components of
+        `partial_network` as blocks into the arrays of `allocate_results`.
+        Missing values do not overwrite results.
+
+        :param bustypes: Bustypes to transfer, defaults to
+        `self.transfer_bustypes`
+        :param series: Dictionary of the series to transfer by bustype,
+        defaults to `self.transfer_series`, None transfers all series
+        """
+        if getattr(self, 'results', None) is None:
+            self.allocate_results()
+        bustypes = self.transfer_bustypes if bustypes is None else bustypes
+        series = self.transfer_series if series is None else series
+        rows = self.original_network.snapshots.get_indexer(
+                partial_network.snapshots)
+        for (bustype, key), (values, columns, filled) in self.results.items():
+            if bustype not in bustypes or (
+                    series is not None and key not in series.get(bustype, {})):
+                continue
+            part = getattr(partial_network, bustype + '_t')[key]
+            part = part.loc[:, part.columns.intersection(
+                    getattr(partial_network, bustype).index)]
+            cols = columns.get_indexer(part.columns)
+            block = part.reindex(partial_network.snapshots).values[
+                    :, cols >= 0]
+            cols = cols[cols >= 0]
+            if not len(cols):
+                continue
+            index = np.ix_(rows, cols)
+            values[index] = np.where(pd.isnull(block), values[index], block)
+            filled[cols] = True
+            self.written.add((bustype, key))
 
     def solve_partial_network(self, cluster, partial_network, scenario,
                               solver=None):
         extras = self.add_constraints(cluster)
         partial_network.lopf(scenario.timeindex,
                              solver_name=solver,
+                             solver_options=self.solver_options,
                              extra_functionality=extras)
 
 class MiniSolverDisaggregation(Disaggregation):
@@ -389,23 +624,154 @@ class MiniSolverDisaggregation(Disaggregation):
         return extra_functionality
 
 class UniformDisaggregation(Disaggregation):
+    transfer_bustypes = ['generators', 'storage_units']
+    transfer_series = {'generators': {'p'},
+                       'storage_units': {'p', 'state_of_charge'}}
+    bustypes = {
+            'generators': {
+                'group_by': ('carrier',),
+                'series': ('p', 'q')},
+            'storage_units': {
+                'group_by': ('carrier', 'max_hours'),
+                'series': ('p', 'state_of_charge', 'q')}}
+    filters = {'q': lambda o: o.control == "PV"}
+
+    def __init__(self, *args, engine='sparse', **kwargs):
+        """
+        :param engine: `'sparse'` disaggregates all clusters at once by
+        sparse weight matrices, `'partial'` disaggregates cluster by cluster
+        on partial networks
+        """
+        super().__init__(*args, **kwargs)
+        self.engine = engine
+
+    def weights(self):
+        """
+        Attributes whose product is the share of a component in the series
+        of its cluster.
+        """
+        return {'p': ('p_nom_opt', 'p_max_pu'),
+                'q': (('p_nom_opt',)
+                      if (getattr(self.clustered_network, 'allocation', None)
+                          ==
+                          'p_nom')
+                      else ('p_nom_opt', 'p_max_pu')),
+                'state_of_charge': ('p_nom_opt',)}
+
+    def solve(self, scenario, solver):
+        if self.engine == 'partial':
+            return super().solve(scenario, solver)
+        if self.engine != 'sparse':
+            raise Exception('Invalid disaggregation engine: ' + self.engine)
+
+        t = time.time()
+        for bustype in self.bustypes:
+            self.disaggregate(bustype)
+        self.stats = {'disaggregate': time.time() - t}
+        print('Disaggregated in ', self.stats['disaggregate'])
+        self.check()
+
+    def disaggregate(self, bustype):
+        """
+        Distribute `'p_nom_opt'` and the series of all clustered components
+        of `bustype` to their original components.
+
+        Each original component is mapped to the clustered component at its
+        cluster with the same `group_by` attributes. The series of all
+        clusters are distributed by one sparse matrix product with the
+        weights of the original components.
+
+        :param bustype: `'generators'` or `'storage_units'`
+        """
+        group_by = list(self.bustypes[bustype]['group_by'])
+        original = getattr(self.original_network, bustype)
+        clustered = getattr(self.clustered_network, bustype)
+        o_t = getattr(self.original_network, bustype + '_t')
+        c_t = getattr(self.clustered_network, bustype + '_t')
+
+        targets = (clustered.loc[:, ['bus'] + group_by]
+                   .rename_axis('target').reset_index())
+        duplicated = targets.duplicated(['bus'] + group_by)
+        if duplicated.any():
+            raise Exception(
+                    "Clusters {} have more than one bus for a group of {}.\n"
+                    .format(list(targets.bus[duplicated].unique()),
+                            group_by) +
+                    "Should be exactly one.")
+        sources = (original.loc[:, group_by]
+                   .assign(bus=original.bus.map(self.clustering.busmap))
+                   .rename_axis('source').reset_index())
+        mapping = sources.merge(targets, how='inner', on=['bus'] + group_by)
+        source = mapping.source.values
+        target = mapping.target.values
+
+        if (original.loc[source, 'p_nom_extendable'].values !=
+                clustered.loc[target, 'p_nom_extendable'].values).any():
+            raise Exception(
+                    "The `'p_nom_extendable'` flag of some clustered " +
+                    bustype + " does not have the same value on the " +
+                    "components of its cluster. This is not supported.")
+
+        # `p_nom_opt` of extendable components is distributed by `p_nom_max`
+        _, codes = np.unique(target, return_inverse=True)
+        incidence = csr_matrix((np.ones(len(codes)),
+                                (np.arange(len(codes)), codes)))
+        p_nom_max = original.loc[source, 'p_nom_max'].values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p_nom_opt = np.where(
+                    original.loc[source, 'p_nom_extendable'].values,
+                    clustered.loc[target, 'p_nom_opt'].values * p_nom_max /
+                    incidence.dot(incidence.T.dot(p_nom_max)),
+                    original.loc[source, 'p_nom'].values)
+        original.loc[source, 'p_nom_opt'] = p_nom_opt
+
+        for s in self.bustypes[bustype]['series']:
+            if s in self.skip or s not in c_t or c_t[s].empty:
+                continue
+            members = pd.Index(target).isin(c_t[s].columns)
+            if s in self.filters:
+                members &= self.filters[s](original.loc[source]).values
+            if not members.any():
+                continue
+            src = source[members]
+            clusters, codes = np.unique(target[members], return_inverse=True)
+            incidence = csr_matrix((np.ones(len(src)),
+                                    (np.arange(len(src)), codes)),
+                                   shape=(len(src), len(clusters)))
+            clt = c_t[s].loc[:, clusters]
+
+            weight = np.ones(len(src))
+            for key in self.weights()[s]:
+                if (key in c_t and not c_t[key].empty and
+                        o_t[key].columns.isin(src).any()):
+                    weight = weight * (
+                            o_t[key].reindex(index=clt.index, columns=src)
+                            .fillna(original.loc[src, key]).values)
+                else:
+                    weight = weight * original.loc[src, key].values
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if weight.ndim == 1:
+                    # constant weights: one cluster -> original matrix
+                    matrix = incidence.multiply(
+                            (weight / incidence.T.dot(weight)[codes])
+                            [:, None]).tocsr()
+                    values = matrix.dot(clt.values.T).T
+                else:
+                    ratio = clt.values / incidence.T.dot(weight.T).T
+                    values = weight * incidence.dot(ratio.T).T
+
+            values = pd.DataFrame(values, index=clt.index, columns=src)
+            o_t[s] = pd.concat(
+                    (o_t[s].drop(src, axis=1, errors='ignore'),
+                     values.reindex(o_t[s].index)),
+                    axis=1)
+
     def solve_partial_network(self, cluster, partial_network, scenario,
                               solver=None):
-        bustypes = {
-                'generators': {
-                    'group_by': ('carrier',),
-                    'series': ('p', 'q')},
-                'storage_units': {
-                    'group_by': ('carrier', 'max_hours'),
-                    'series': ('p', 'state_of_charge', 'q')}}
-        weights = {'p': ('p_nom_opt', 'p_max_pu'),
-                   'q': (('p_nom_opt',)
-                       if (getattr(self.clustered_network, 'allocation', None)
-                           ==
-                           'p_nom')
-                       else ('p_nom_opt', 'p_max_pu')),
-                   'state_of_charge': ('p_nom_opt',)}
-        filters = {'q': lambda o: o.control == "PV"}
+        bustypes = self.bustypes
+        weights = self.weights()
+        filters = self.filters
         for bustype in bustypes:
             pn_t = getattr(partial_network, bustype + '_t')
             cl_t = getattr(self.clustered_network, bustype + '_t')
@@ -507,38 +873,23 @@ class UniformDisaggregation(Disaggregation):
                         pn_t[s].insert(len(pn_t[s].columns), bus_id, values)
 
 
-    def transfer_results(self, *args, **kwargs):
-        kwargs['bustypes'] = ['generators', 'storage_units']
-        kwargs['series'] = {'generators': {'p'},
-                            'storage_units': {'p', 'state_of_charge'}}
-        return super().transfer_results(*args, **kwargs)
-
-
-def swap_series(s):
-    return pd.Series(s.index.values, index=s)
-
-
-def filter_internal_connector(conn, is_bus_in_cluster):
-    return conn[conn.bus0.apply(is_bus_in_cluster)
-                & conn.bus1.apply(is_bus_in_cluster)]
 
 
-def filter_left_external_connector(conn, is_bus_in_cluster):
-    return conn[~ conn.loc[:, 'bus0'].apply(is_bus_in_cluster)
-                & conn.loc[:, 'bus1'].apply(is_bus_in_cluster)]
+_disaggregation = None
 
 
-def filter_right_external_connector(conn, is_bus_in_cluster):
-    return conn[conn.bus0.apply(is_bus_in_cluster)
-                & ~conn.bus1.apply(is_bus_in_cluster)]
+def _init_disaggregation(data):
+    global _disaggregation
+    _disaggregation = data
 
 
-def filter_buses(bus, buses):
-    return bus[bus.bus.isin(buses)]
+def _solve_cluster(cluster):
+    disaggregation, scenario, solver = _disaggregation
+    return disaggregation.solve_cluster(cluster, scenario, solver)
 
 
-def filter_on_buses(connecitve, buses):
-    return connecitve[connecitve.bus.isin(buses)]
+def swap_series(s):
+    return pd.Series(s.index.values, index=s)
 
 
 def update_constraints(network, externals):
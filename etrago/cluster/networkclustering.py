@@ -22,6 +22,9 @@
 spatially for applications within the tool eTraGo."""
 
 import os
+import hashlib
+import heapq
+import time
 if 'READTHEDOCS' not in os.environ:
     from etrago.tools.utilities import *
     from pypsa.networkclustering import (aggregatebuses, aggregateoneport,
@@ -29,14 +32,19 @@ if 'READTHEDOCS' not in os.environ:
                                          get_clustering_from_busmap,
                                          busmap_by_kmeans, busmap_by_stubs)
     from egoio.db_tables.model_draft import EgoGridPfHvBusmap
+    from etrago.tools.cache import LocalCache, network_fingerprint
+    from etrago.tools.io import bulk_insert
 
     from itertools import product
     import networkx as nx
     import multiprocessing as mp
     from math import ceil
+    import numpy as np
     import pandas as pd
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra
+    from scipy.spatial import cKDTree
     from networkx import NetworkXNoPath
-    from pickle import dump
     from pypsa import Network
     import pypsa.io as io
     import pypsa.components as components
@@ -53,16 +61,154 @@ __author__ = "s3pp, wolfbunke, ulfmueller, lukasol"
 # TODO: Workaround because of agg
 
 
-def _leading(busmap, df):
+def _group_codes(bus, carrier=None):
+    """ Integer codes and names of aggregated one-port components.
+
+    Groups are named as by pypsa.networkclustering, i.e. '<bus> <carrier>'
+    or '<bus>', and sorted by name.
     """
+
+    keys = bus.astype(str)
+    if carrier is not None:
+        keys = keys + ' ' + carrier.astype(str)
+
+    codes, names = pd.factorize(keys, sort=True)
+
+    return codes, pd.Index(names, name='name')
+
+
+def _incidence(codes, n_groups, weights=None):
+    """ Sparse matrix mapping components (columns) to groups (rows). """
+
+    n = len(codes)
+    if weights is None:
+        weights = np.ones(n)
+
+    return csr_matrix((weights, (codes, np.arange(n))), shape=(n_groups, n))
+
+
+def aggregate_one_port(network, busmap, component, with_time=True):
+    """ Aggregates a one-port component per bus and carrier using sparse
+    matrix products.
+
+    Follows the strategies of pypsa's aggregategenerators and
+    aggregateoneport: powers and nominal powers are summed up, p_nom_max of
+    generators is the minimum relative to their weight, p_max_pu and
+    capital_cost of generators are averaged by weight, max_hours is
+    averaged by p_nom and all other input attributes are taken from the
+    first member of each group. Time series are reduced with one
+    multiplication by the incidence matrix of components and groups.
+
+    Parameters
+    ----------
+    network : pypsa.Network
+        Container for all network components.
+
+    busmap : dict
+        Maps old bus_ids to new bus_ids.
+
+    component : str
+        Name of the one-port component, e.g. 'Generator'.
+
+    with_time : bool
+        If true time-varying data will also be aggregated.
+
+    Returns
+    -------
+    new_df : pd.DataFrame
+        Static data of the aggregated components.
+
+    new_pnl : dict
+        Time series of the aggregated components.
     """
-    def leader(x):
-        ix = busmap[x.index[0]]
-        return df.loc[ix, x.name]
-    return leader
 
+    attrs = network.components[component]['attrs']
+    old_df = network.df(component)
+    bus = old_df.bus.map(busmap)
+
+    columns = [col for col in old_df.columns if col in attrs.index and
+               attrs.at[col, 'static'] and
+               str(attrs.at[col, 'status']).startswith('Input')]
 
-def cluster_on_extra_high_voltage(network, busmap, with_time=True):
+    if component == 'Generator':
+        columns += ['weight'] if 'weight' in old_df.columns else []
+        strategies = {'p_nom': 'sum', 'weight': 'sum', 'p_nom_max': 'min',
+                      'capital_cost': 'weighted'}
+    else:
+        strategies = {'p': 'sum', 'q': 'sum', 'p_set': 'sum', 'q_set': 'sum',
+                      'p_nom': 'sum', 'p_nom_max': 'sum', 'p_nom_min': 'sum',
+                      'max_hours': 'max_hours'}
+
+    carrier = (old_df.carrier if 'carrier' in columns or
+               component == 'Generator' else None)
+    codes, names = _group_codes(bus, carrier)
+    first = np.unique(codes, return_index=True)[1]
+    S = _incidence(codes, len(names))
+
+    # weight of each component within its group
+    if 'weight' in old_df.columns:
+        weight = old_df.weight.values.astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = weight / S.dot(weight)[codes]
+        weight[~np.isfinite(weight)] = 1.
+    else:
+        weight = np.ones(len(old_df))
+
+    new_df = pd.DataFrame(index=names)
+
+    for col in columns:
+        strategy = strategies.get(col, 'first')
+        values = old_df[col]
+
+        if col == 'bus':
+            new_df[col] = bus.values[first]
+        elif strategy == 'sum':
+            new_df[col] = S.dot(values.fillna(0).values.astype(float))
+        elif strategy == 'weighted':
+            new_df[col] = S.dot(values.fillna(0).values * weight)
+        elif strategy == 'min':
+            new_df[col] = (values / weight).groupby(codes).min().values
+        elif strategy == 'max_hours':
+            # average weighted by p_nom over the units with max_hours,
+            # equal shares if their p_nom sums to 0, e.g. extendable storage
+            given = values.notnull().values.astype(float)
+            p_nom = old_df.p_nom.fillna(0).values.astype(float) * given
+            with np.errstate(invalid='ignore', divide='ignore'):
+                share = p_nom / S.dot(p_nom)[codes]
+                equal = given / S.dot(given)[codes]
+            share = np.where(np.isfinite(share), share, equal)
+            share[~np.isfinite(share)] = 0.
+            grouped = values.groupby(codes)
+            new_df[col] = np.where(
+                (grouped.min() == grouped.max()).values |
+                (grouped.count() == 0).values,
+                grouped.first().reindex(range(len(names))).values,
+                S.dot(values.fillna(0).values * share))
+        else:
+            new_df[col] = values.values[first]
+
+    new_pnl = dict()
+    if with_time:
+        codes = pd.Series(codes, index=old_df.index)
+        weight = pd.Series(weight, index=old_df.index)
+        for attr, df in iteritems(network.pnl(component)):
+            if df.empty:
+                continue
+            col_codes = codes.reindex(df.columns).values
+            S_t = _incidence(col_codes, len(names),
+                             weight.reindex(df.columns).values
+                             if component == 'Generator' and
+                             attr == 'p_max_pu' else None)
+            used = np.unique(col_codes)
+            new_pnl[attr] = pd.DataFrame(
+                S_t.dot(df.fillna(0).values.T).T[:, used],
+                index=df.index, columns=names[used])
+
+    return new_df, new_pnl
+
+
+def cluster_on_extra_high_voltage(network, busmap, with_time=True,
+                                  engine='sparse'):
     """ Main function of the EHV-Clustering approach. Creates a new clustered
     pypsa.Network given a busmap mapping all bus_ids to other bus_ids of the
     same network.
@@ -78,32 +224,40 @@ def cluster_on_extra_high_voltage(network, busmap, with_time=True):
     with_time : bool
         If true time-varying data will also be aggregated.
 
+    engine : str
+        'sparse' aggregates one-port components with
+        :func:`aggregate_one_port`, 'pypsa' with aggregategenerators and
+        aggregateoneport of pypsa.networkclustering.
+
     Returns
     -------
     network : pypsa.Network
         Container for all network components of the clustered network.
     """
 
+    if engine not in ['sparse', 'pypsa']:
+        raise Exception('Invalid engine for the ehv clustering: '
+                        + str(engine))
+
     network_c = Network()
 
-    buses = aggregatebuses(
-        network, busmap, {
-            'x': _leading(
-                busmap, network.buses), 'y': _leading(
-                busmap, network.buses)})
+    # coordinates of the bus each cluster is mapped to
+    buses = aggregatebuses(network, busmap, {'x': 'first', 'y': 'first'})
+    buses['x'] = network.buses.x.reindex(buses.index).values
+    buses['y'] = network.buses.y.reindex(buses.index).values
 
     # keep attached lines
-    lines = network.lines.copy()
+    lines = network.lines
     mask = lines.bus0.isin(buses.index)
     lines = lines.loc[mask, :]
 
     # keep attached links
-    links = network.links.copy()
+    links = network.links
     mask = links.bus0.isin(buses.index)
     links = links.loc[mask, :]
 
     # keep attached transformer
-    transformers = network.transformers.copy()
+    transformers = network.transformers
     mask = transformers.bus0.isin(buses.index)
     transformers = transformers.loc[mask, :]
 
@@ -120,18 +274,16 @@ def cluster_on_extra_high_voltage(network, busmap, with_time=True):
     # dealing with generators
     network.generators.control = "PV"
     network.generators['weight'] = 1
-    new_df, new_pnl = aggregategenerators(network, busmap, with_time)
-    io.import_components_from_dataframe(network_c, new_df, 'Generator')
-    for attr, df in iteritems(new_pnl):
-        io.import_series_from_dataframe(network_c, df, 'Generator', attr)
-
-    # dealing with all other components
-    aggregate_one_ports = components.one_port_components.copy()
-    aggregate_one_ports.discard('Generator')
 
-    for one_port in aggregate_one_ports:
-        new_df, new_pnl = aggregateoneport(
-            network, busmap, component=one_port, with_time=with_time)
+    for one_port in sorted(components.one_port_components):
+        if engine == 'sparse':
+            new_df, new_pnl = aggregate_one_port(
+                network, busmap, one_port, with_time=with_time)
+        elif one_port == 'Generator':
+            new_df, new_pnl = aggregategenerators(network, busmap, with_time)
+        else:
+            new_df, new_pnl = aggregateoneport(
+                network, busmap, component=one_port, with_time=with_time)
         io.import_components_from_dataframe(network_c, new_df, one_port)
         for attr, df in iteritems(new_pnl):
             io.import_series_from_dataframe(network_c, df, one_port, attr)
@@ -227,8 +379,178 @@ def shortest_path(paths, graph):
     return df
 
 
+def line_graph(lines, nodes):
+    """ Sparse adjacency matrix of lines weighted by their length.
+
+    Parallel lines count with their minimum length.
+
+    Parameters
+    ----------
+    lines : pd.DataFrame
+        Lines with columns bus0, bus1 and length.
+
+    nodes : list
+        Additional nodes of the graph.
+
+    Returns
+    -------
+    graph : scipy.sparse.csr_matrix
+        Upper triangular adjacency matrix, to be used as undirected graph.
+
+    nodes : pd.Index
+        Nodes in the order of rows and columns of graph.
+    """
+
+    nodes = pd.Index(pd.unique(np.concatenate([
+        lines.bus0.values, lines.bus1.values, np.asarray(nodes)])))
+
+    edges = pd.DataFrame({'i': nodes.get_indexer(lines.bus0),
+                          'j': nodes.get_indexer(lines.bus1),
+                          'length': lines.length.values.astype(float)})
+    swap = edges.i > edges.j
+    edges.loc[swap, ['i', 'j']] = edges.loc[swap, ['j', 'i']].values
+    edges = edges.groupby(['i', 'j'], as_index=False).length.min()
+
+    graph = csr_matrix((edges.length.values,
+                        (edges.i.values, edges.j.values)),
+                       shape=(len(nodes), len(nodes)))
+
+    return graph, nodes
+
+
+def nearest_targets(lines, sources, targets):
+    """ Finds the nearest target node of each source node along lines.
+
+    All path lengths are computed by a single call of scipy's dijkstra on a
+    sparse adjacency matrix, starting from the distinct target nodes or, if
+    there are fewer, from the source nodes. As in :func:`shortest_path`,
+    parallel lines count with their minimum length.
+
+    Parameters
+    ----------
+    lines : pd.DataFrame
+        Lines with columns bus0, bus1 and length.
+
+    sources : list
+        Source nodes.
+
+    targets : list
+        Target nodes.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Source, nearest target and path_length for each source node that
+        is connected to a target. Ties are resolved by the smallest target.
+    """
+
+    sources = np.asarray(sources)
+    targets = np.sort(pd.unique(np.asarray(targets)))
+    if not len(sources) or not len(targets):
+        return pd.DataFrame(columns=['source', 'target', 'path_length'])
+
+    graph, nodes = line_graph(lines, np.concatenate([sources, targets]))
+
+    if len(sources) < len(targets):
+        dist = dijkstra(graph, directed=False,
+                        indices=nodes.get_indexer(sources))
+        dist = dist[:, nodes.get_indexer(targets)].T
+    else:
+        dist = dijkstra(graph, directed=False,
+                        indices=nodes.get_indexer(targets))
+        dist = dist[:, nodes.get_indexer(sources)]
+
+    nearest = dist.argmin(axis=0)
+    path_length = dist[nearest, np.arange(len(sources))]
+    reachable = np.isfinite(path_length)
+
+    return pd.DataFrame({
+        'source': sources[reachable],
+        'target': targets[nearest[reachable]],
+        'path_length': path_length[reachable]},
+        columns=['source', 'target', 'path_length'])
+
+
+def affected_buses(lines, sources, path_length, changed):
+    """ Finds the buses whose nearest target can differ from a previous
+    busmap after branches or transformers were added or removed.
+
+    The shortest path of a bus with a new nearest target passes an end
+    point of a changed branch within the previous path length. Buses
+    farther away from all changed buses keep their previous assignment.
+
+    Parameters
+    ----------
+    lines : pd.DataFrame
+        Current lines with columns bus0, bus1 and length.
+
+    sources : list
+        Buses to check.
+
+    path_length : array-like
+        Previous path length of each source, NaN if it was not mapped.
+
+    changed : list
+        End points of added or removed lines and HV buses of added or
+        removed transformers.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of affected sources.
+    """
+
+    sources = np.asarray(sources)
+    path_length = np.asarray(path_length, dtype=float)
+
+    graph, nodes = line_graph(lines, sources)
+    changed = [b for b in pd.unique(np.asarray(changed)) if b in nodes]
+
+    if not changed:
+        return np.isnan(path_length)
+
+    dist = dijkstra(graph, directed=False,
+                    indices=nodes.get_indexer(changed))
+    dist = dist[:, nodes.get_indexer(sources)].min(axis=0)
+
+    # tolerance for path lengths summed up in a different order
+    return np.isnan(path_length) | (
+        dist <= path_length * (1 + 1e-9) + 1e-9)
+
+
+def changed_buses(network):
+    """ Buses connected to branches of extension scenarios or to lines
+    removed by :func:`etrago.tools.io.decommissioning`.
+
+    Parameters
+    ----------
+    network : pypsa.Network object
+        Container for all network components.
+
+    Returns
+    -------
+    list
+        Bus ids.
+    """
+
+    buses = set()
+    for df in [network.lines, network.links, network.transformers]:
+        if 'scn_name' in df:
+            ext = df[df.scn_name.astype(str).str.startswith('extension_')]
+            buses.update(ext.bus0)
+            buses.update(ext.bus1)
+
+    removed = getattr(network, 'decommissioned_lines', None)
+    if removed is not None:
+        buses.update(removed.bus0)
+        buses.update(removed.bus1)
+
+    return sorted(buses)
+
+
 def busmap_by_shortest_path(network, session, scn_name, version, fromlvl,
-                            tolvl, cpu_cores=4):
+                            tolvl, cpu_cores=4, backend=None,
+                            engine='csgraph', base=None, changed=None):
     """ Creates a busmap for the EHV-Clustering between voltage levels based
     on dijkstra shortest path. The result is automatically written to the
     `model_draft` on the <OpenEnergyPlatform>[www.openenergy-platform.org]
@@ -256,15 +578,33 @@ def busmap_by_shortest_path(network, session, scn_name, version, fromlvl,
         List of voltage-levels to remain.
 
     cpu_cores : int
-        Number of CPU-cores.
+        Number of CPU-cores, only used by the networkx engine.
+
+    backend : :class:`etrago.tools.backend.LocalBackend` or None
+        If given, the busmap is written to this local database instead of
+        the oedb.
+
+    engine : str
+        'csgraph' computes all path lengths in one pass with
+        :func:`nearest_targets`. 'networkx' runs one dijkstra per pair of
+        buses on cpu_cores processes.
+
+    base : pd.DataFrame or None
+        Busmap of a base scenario with columns bus0, bus1 and path_length.
+        If given, only the buses returned by :func:`affected_buses` are
+        recomputed, all others keep their assignment in base.
+
+    changed : list or None
+        Buses connected to branches that differ from the base scenario,
+        see :func:`changed_buses`. Defaults to changed_buses(network).
 
     Returns
     -------
-    None
+    df : pd.DataFrame
+        The busmap as written, with columns scn_name, bus0, bus1, version
+        and path_length.
     """
 
-    # cpu_cores = mp.cpu_count()
-
     # data preperation
     s_buses = buses_grid_linked(network, fromlvl)
     lines = connected_grid_lines(network, s_buses)
@@ -274,31 +614,59 @@ def busmap_by_shortest_path(network, session, scn_name, version, fromlvl,
     # temporary end points, later replaced by bus1 pendant
     t_buses = transformer[mask].bus0
 
-    # create all possible pathways
-    ppaths = list(product(s_buses, t_buses))
-
-    # graph creation
-    edges = [(row.bus0, row.bus1, row.length, ix) for ix, row
-             in lines.iterrows()]
-    M = graph_from_edges(edges)
+    sources = s_buses
+    if base is not None:
+        if changed is None:
+            changed = changed_buses(network)
+        base = base.set_index('bus0')
+        affected = affected_buses(
+            lines, s_buses,
+            base.path_length.reindex(s_buses).astype(float).values, changed)
+        sources = s_buses[affected]
+        kept = pd.DataFrame({
+            'source': s_buses[~affected],
+            'target': base.bus1.reindex(s_buses[~affected]).values,
+            'path_length': base.path_length.reindex(
+                s_buses[~affected]).astype(float).values},
+            columns=['source', 'target', 'path_length'])
+        print('Busmap: %d of %d buses affected by the extension.'
+              % (len(sources), len(s_buses)))
+
+    if engine == 'csgraph':
+        df = nearest_targets(lines, list(sources), list(t_buses))
+
+    elif engine == 'networkx':
+        # create all possible pathways
+        ppaths = list(product(sources, t_buses))
+
+        # graph creation
+        edges = [(row.bus0, row.bus1, row.length, ix) for ix, row
+                 in lines.iterrows()]
+        M = graph_from_edges(edges)
+
+        # applying multiprocessing
+        p = mp.Pool(cpu_cores)
+        chunksize = ceil(len(ppaths) / cpu_cores)
+        container = p.starmap(shortest_path, gen(ppaths, chunksize, M))
+        p.close()
+        df = pd.concat(container)
+
+        # post processing
+        df.sortlevel(inplace=True)
+        mask = df.groupby(level='source')['path_length'].idxmin()
+        df = df.loc[mask, :]
+        df.reset_index(inplace=True)
 
-    # applying multiprocessing
-    p = mp.Pool(cpu_cores)
-    chunksize = ceil(len(ppaths) / cpu_cores)
-    container = p.starmap(shortest_path, gen(ppaths, chunksize, M))
-    df = pd.concat(container)
-    dump(df, open('df.p', 'wb'))
-
-    # post processing
-    df.sortlevel(inplace=True)
-    mask = df.groupby(level='source')['path_length'].idxmin()
-    df = df.loc[mask, :]
+    else:
+        raise Exception('Invalid engine for shortest paths: ' + str(engine))
 
     # rename temporary endpoints
-    df.reset_index(inplace=True)
     df.target = df.target.map(dict(zip(network.transformers.bus0,
                                        network.transformers.bus1)))
 
+    if base is not None:
+        df = pd.concat([df, kept], ignore_index=True, axis=0)
+
     # append to busmap buses only connected to transformer
     transformer = network.transformers
     idx = list(set(buses_of_vlvl(network, fromlvl)).
@@ -332,15 +700,54 @@ def busmap_by_shortest_path(network, session, scn_name, version, fromlvl,
     df.rename(columns={'source': 'bus0', 'target': 'bus1'}, inplace=True)
     df.set_index(['scn_name', 'bus0', 'bus1'], inplace=True)
 
-    for i, d in df.reset_index().iterrows():
-        session.add(EgoGridPfHvBusmap(**d.to_dict()))
+    df = df.reset_index()
+
+    if backend is not None:
+        backend.write('EgoGridPfHvBusmap', df,
+                      scn_name=scn_name, version=version)
+        return df
 
+    bulk_insert(session, EgoGridPfHvBusmap.__table__, df)
     session.commit()
 
-    return
+    return df
+
+
+def topology_fingerprint(network, fromlvl=[110],
+                         tolvl=[220, 380, 400, 450]):
+    """ Hash of everything the EHV busmap depends on: buses and their
+    voltage levels, lines with their lengths and transformers.
+
+    Parameters
+    ----------
+    network : pypsa.Network object
+        Container for all network components.
+
+    fromlvl : list
+        List of voltage-levels to cluster.
+
+    tolvl : list
+        List of voltage-levels to remain.
+
+    Returns
+    -------
+    str
+        Key of the busmap in a :class:`etrago.tools.cache.LocalCache`.
+    """
+
+    frames = [network.buses[['v_nom']],
+              network.lines[['bus0', 'bus1', 'length']],
+              network.transformers[['bus0', 'bus1']]]
+
+    hashes = [pd.util.hash_pandas_object(df.sort_index()).sum()
+              for df in frames]
+
+    return LocalCache.key('busmap', fromlvl, tolvl,
+                          [str(h) for h in hashes])
 
 
-def busmap_from_psql(network, session, scn_name, version):
+def busmap_from_psql(network, session, scn_name, version, backend=None,
+                     cache=None, cpu_cores=None, base_scn_name=None):
     """ Retrieves busmap from `model_draft.ego_grid_pf_hv_busmap` on the
     <OpenEnergyPlatform>[www.openenergy-platform.org] by a given scenario
     name. If this busmap does not exist, it is created with default values.
@@ -356,122 +763,166 @@ def busmap_from_psql(network, session, scn_name, version):
     scn_name : str
         Name of the scenario.
 
+    backend : :class:`etrago.tools.backend.LocalBackend` or None
+        Local database to read the busmap from instead of the oedb.
+
+    cache : :class:`etrago.tools.cache.LocalCache`, str or None
+        Local cache or its directory. Busmaps are stored under the
+        :func:`topology_fingerprint` of the network and reused for every
+        scenario with the same grid, without querying the database.
+
+    cpu_cores : int or None
+        Number of CPU-cores used if the busmap is created with the networkx
+        engine. None uses all cores.
+
+    base_scn_name : str or None
+        Scenario without extensions, e.g. 'NEP 2035'. If the busmap of
+        scn_name has to be created and the one of base_scn_name exists,
+        only the buses near extended or decommissioned branches are
+        recomputed.
+
     Returns
     -------
     busmap : dict
         Maps old bus_ids to new bus_ids.
     """
 
-    def fetch():
+    if isinstance(cache, str):
+        cache = LocalCache(cache)
+
+    if cache is not None:
+        key = topology_fingerprint(network)
+        if key in cache:
+            print('Busmap loaded from %s' % cache)
+            df = cache.load_frame(key)
+            return dict(zip(df.bus0, df.bus1))
+
+    def fetch(scn_name):
+
+        columns = ['bus0', 'bus1', 'path_length']
 
-        query = session.query(EgoGridPfHvBusmap.bus0, EgoGridPfHvBusmap.bus1).\
+        if backend is not None:
+            return backend.read('EgoGridPfHvBusmap', columns=columns,
+                                scn_name=scn_name, version=version)
+
+        query = session.query(
+            *[getattr(EgoGridPfHvBusmap, col) for col in columns]).\
             filter(EgoGridPfHvBusmap.scn_name == scn_name).filter(
                     EgoGridPfHvBusmap.version == version)
 
-        return dict(query.all())
+        return pd.read_sql(query.statement, session.bind)
 
-    busmap = fetch()
+    busmap = fetch(scn_name)
 
     # TODO: Or better try/except/finally
-    if not busmap:
+    if busmap.empty:
         print('Busmap does not exist and will be created.\n')
 
-        cpu_cores = input('cpu_cores (default 4): ') or '4'
+        base = None
+        if base_scn_name is not None:
+            base = fetch(base_scn_name)
+            if base.empty:
+                base = None
+            else:
+                print('Updating busmap of %s.' % base_scn_name)
+
+        busmap = busmap_by_shortest_path(
+            network, session, scn_name, version, fromlvl=[110],
+            tolvl=[220, 380, 400, 450],
+            cpu_cores=cpu_cores or mp.cpu_count(), backend=backend,
+            base=base)
+
+    busmap = dict(zip(busmap.bus0, busmap.bus1))
 
-        busmap_by_shortest_path(network, session, scn_name, version,
-                                fromlvl=[110], tolvl=[220, 380, 400, 450],
-                                cpu_cores=int(cpu_cores))
-        busmap = fetch()
+    if cache is not None:
+        cache.store_frame(key, pd.DataFrame(list(busmap.items()),
+                                            columns=['bus0', 'bus1']))
 
     return busmap
 
 
-def kmean_clustering(network, n_clusters=10, load_cluster=False,
-                     line_length_factor=1.25,
-                     remove_stubs=False, use_reduced_coordinates=False,
-                     bus_weight_tocsv=None, bus_weight_fromcsv=None,
-                     n_init=10, max_iter=300, tol=1e-4,
-                     n_jobs=1):
-    """ Main function of the k-mean clustering approach. Maps an original
-    network to a new one with adjustable number of nodes and new coordinates.
+def bus_weighting(network, save=None):
+    """ Weighting of buses for the k-mean clustering based on the spatial
+    distribution of conventional generation and of the load.
 
     Parameters
     ----------
     network : :class:`pypsa.Network
         Container for all network components.
 
-    n_clusters : int
-        Desired number of clusters.
+    save : str or None
+        Path of a csv file to save the weighting to.
 
-    load_cluster : boolean
-        Loads cluster coordinates from a former calculation.
+    Returns
+    -------
+    weight : pd.Series
+        Integer weight of each bus.
+    """
 
-    line_length_factor : float
-        Factor to multiply the crow-flies distance between new buses in order
-        to get new line lengths.
+    def normed(x):
+        return (x / x.sum()).fillna(0.)
 
-    remove_stubs: boolean
-        Removes stubs and stubby trees (i.e. sequentially reducing dead-ends).
+    # define weighting based on conventional 'old' generator spatial
+    # distribution
+    non_conv_types = {
+            'biomass',
+            'wind_onshore',
+            'wind_offshore',
+            'solar',
+            'geothermal',
+            'load shedding',
+            'extendable_storage'}
+    # Attention: network.generators.carrier.unique()
+    gen = (network.generators.loc[(network.generators.carrier
+                               .isin(non_conv_types) == False)]
+       .groupby('bus').p_nom.sum()
+                            .reindex(network.buses.index, fill_value=0.) +
+       network.storage_units
+                            .loc[(network.storage_units.carrier
+                                  .isin(non_conv_types) == False)]
+              .groupby('bus').p_nom.sum()
+              .reindex(network.buses.index, fill_value=0.))
+
+    load = network.loads_t.p_set.mean().groupby(network.loads.bus).sum()
+
+    b_i = network.buses.index
+    g = normed(gen.reindex(b_i, fill_value=0))
+    l = normed(load.reindex(b_i, fill_value=0))
+
+    w = g + l
+    weight = ((w * (100000. / w.max())).astype(int)
+              ).reindex(network.buses.index, fill_value=1)
+
+    if save:
+        weight.to_csv(save)
+
+    return weight
+
+
+def kmeans_preprocessing(network, bus_weight_tocsv=None,
+                         bus_weight_fromcsv=None):
+    """ Prepares a network for the k-mean clustering in place: lines are
+    normalised to 380 kV, transformers are converted to lines and the bus
+    weighting is determined.
 
-    use_reduced_coordinates: boolean
-        If True, do not average cluster coordinates, but take from busmap.
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Container for all network components.
 
     bus_weight_tocsv : str
         Creates a bus weighting based on conventional generation and load
         and save it to a csv file.
 
     bus_weight_fromcsv : str
-        Loads a bus weighting from a csv file to apply it to the clustering
-        algorithm.
+        Loads a bus weighting from a csv file.
 
     Returns
     -------
-    network : pypsa.Network object
-        Container for all network components.
+    weight : pd.Series
+        Weight of each bus.
     """
-    def weighting_for_scenario(x, save=None):
-        """
-        """
-        # define weighting based on conventional 'old' generator spatial
-        # distribution
-        non_conv_types = {
-                'biomass',
-                'wind_onshore',
-                'wind_offshore',
-                'solar',
-                'geothermal',
-                'load shedding',
-                'extendable_storage'}
-        # Attention: network.generators.carrier.unique()
-        gen = (network.generators.loc[(network.generators.carrier
-                                   .isin(non_conv_types) == False)]
-           .groupby('bus').p_nom.sum()
-                                .reindex(network.buses.index, fill_value=0.) +
-           network.storage_units
-                                .loc[(network.storage_units.carrier
-                                      .isin(non_conv_types) == False)]
-                  .groupby('bus').p_nom.sum()
-                  .reindex(network.buses.index, fill_value=0.))
-
-        load = network.loads_t.p_set.mean().groupby(network.loads.bus).sum()
-
-        b_i = x.index
-        g = normed(gen.reindex(b_i, fill_value=0))
-        l = normed(load.reindex(b_i, fill_value=0))
-
-        w = g + l
-        weight = ((w * (100000. / w.max())).astype(int)
-                  ).reindex(network.buses.index, fill_value=1)
-
-        if save:
-            weight.to_csv(save)
-
-        return weight
-
-    def normed(x):
-        return (x / x.sum()).fillna(0.)
 
-    print('start k-mean clustering')
     # prepare k-mean
     # k-means clustering (first try)
     network.generators.control = "PV"
@@ -520,13 +971,429 @@ def kmean_clustering(network, n_clusters=10, load_cluster=False,
     # State whether to create a bus weighting and save it, create or not save
     # it, or use a bus weighting from a csv file
     if bus_weight_tocsv is not None:
-        weight = weighting_for_scenario(x=network.buses, save=bus_weight_tocsv)
+        weight = bus_weighting(network, save=bus_weight_tocsv)
     elif bus_weight_fromcsv is not None:
         weight = pd.Series.from_csv(bus_weight_fromcsv)
         weight.index = weight.index.astype(str)
     else:
-        weight = weighting_for_scenario(x=network.buses, save=False)
+        weight = bus_weighting(network)
+
+    return weight
+
+
+def _kmeans_plusplus(points, weights, n_clusters, random_state,
+                     centres=None):
+    """ Adds centres by weighted k-means++ seeding until there are
+    n_clusters. """
+
+    if centres is None or not len(centres):
+        centres = points[[random_state.choice(
+            len(points), p=weights / weights.sum())]]
+
+    while len(centres) < n_clusters:
+        d = weights * cKDTree(centres).query(points)[0]**2
+        if not d.sum() > 0:
+            d = weights
+        centres = np.vstack([centres, points[random_state.choice(
+            len(points), p=d / d.sum())]])
+
+    return centres
+
+
+def _lloyd(points, weights, centres, max_iter, tol):
+    """ Weighted k-means iterations from given centres.
+
+    Returns the assignment of the points, the weighted sum of squared
+    distances and the number of iterations.
+    """
+
+    n_clusters = len(centres)
+    tol = tol * points.var(axis=0).mean()
+
+    for i in range(max_iter):
+        dist, assign = cKDTree(centres).query(points)
+        S = _incidence(assign, n_clusters, weights)
+        size = S.dot(np.ones(len(points)))
+        new = centres.copy()
+        filled = size > 0
+        new[filled] = S.dot(points)[filled] / size[filled, None]
+        # move empty clusters to the worst represented buses
+        for j, far in zip(np.where(~filled)[0],
+                          np.argsort(-weights * dist**2)):
+            new[j] = points[far]
+        shift = ((new - centres)**2).sum()
+        centres = new
+        if shift <= tol:
+            break
 
+    dist, assign = cKDTree(centres).query(points)
+
+    return assign, (weights * dist**2).sum(), i + 1
+
+
+def _partition_kmeans(points, weights, n_clusters, n_init, max_iter, tol,
+                      seed):
+    """ Best of n_init weighted k-means runs, as run by the processes of
+    :func:`busmap_by_partition`. """
+
+    random_state = np.random.RandomState(seed)
+    best = None
+
+    for _ in range(n_init):
+        centres = _kmeans_plusplus(points, weights, n_clusters,
+                                   random_state)
+        assign, inertia, _ = _lloyd(points, weights, centres, max_iter, tol)
+        if best is None or inertia < best[1]:
+            best = (assign, inertia)
+
+    return best[0]
+
+
+def allocate_clusters(weight, size, n_clusters):
+    """ Distributes a number of clusters among partitions proportionally
+    to their weight, with at least one and at most size clusters each.
+
+    Uses the highest averages method, i.e. clusters are assigned one by
+    one to the partition with the largest weight per cluster.
+
+    Parameters
+    ----------
+    weight : pd.Series
+        Weight of each partition.
+
+    size : pd.Series
+        Number of buses of each partition.
+
+    n_clusters : int
+        Total number of clusters.
+
+    Returns
+    -------
+    pd.Series
+        Number of clusters of each partition.
+    """
+
+    size = size.reindex(weight.index)
+    if n_clusters < len(weight) or n_clusters > size.sum():
+        raise Exception('%d clusters can not be distributed among %d '
+                        'partitions with %d buses.'
+                        % (n_clusters, len(weight), size.sum()))
+
+    weight = weight.astype(float) + 1e-9
+    k = pd.Series(1, index=weight.index)
+
+    # highest averages method: the next cluster goes to the partition with
+    # the largest weight per cluster
+    heap = [(-weight[p] / 2, p) for p in weight.index if size[p] > 1]
+    heapq.heapify(heap)
+    for _ in range(n_clusters - len(weight)):
+        _, p = heapq.heappop(heap)
+        k[p] += 1
+        if k[p] < size[p]:
+            heapq.heappush(heap, (-weight[p] / (k[p] + 1), p))
+
+    return k
+
+
+def busmap_by_partition(network, weight, n_clusters, partition,
+                        processes=None, n_init=10, max_iter=300, tol=1e-4,
+                        random_state=None):
+    """ Clusters each partition of the buses, e.g. each country,
+    separately in parallel processes.
+
+    The clusters are allocated to the partitions by
+    :func:`allocate_clusters` according to their weight. No cluster spans
+    two partitions, so lines between partitions are kept.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Container for all network components.
+
+    weight : pd.Series
+        Weight of each bus.
+
+    n_clusters : int
+        Desired total number of clusters.
+
+    partition : pd.Series
+        Maps bus_ids to partitions, e.g. network.buses.country_code.
+
+    processes : int or None
+        Number of processes, None uses all cores.
+
+    n_init, max_iter, tol
+        Parameters of the k-means algorithm.
+
+    random_state : int or None
+        Seed of the initialisation.
+
+    Returns
+    -------
+    busmap : pd.Series
+        Maps bus_ids to clusters named '<partition>_<number>'.
+    """
+
+    partition = partition.reindex(network.buses.index).fillna('').astype(str)
+    w = weight.reindex(network.buses.index, fill_value=0).astype(float) + 1e-9
+
+    k = allocate_clusters(w.groupby(partition).sum(),
+                          partition.value_counts(), n_clusters)
+    print('Clusters per partition: ' + ', '.join(
+        '%s: %d' % (p, n) for p, n in k.items()))
+
+    seeds = np.random.RandomState(random_state).randint(
+        2**31 - 1, size=len(k))
+    tasks = []
+    for (p, n), seed in zip(k.items(), seeds):
+        members = (partition == p).values
+        tasks.append((network.buses.loc[members, ['x', 'y']].values
+                      .astype(float), w.values[members], n, n_init,
+                      max_iter, tol, seed))
+
+    if processes == 1:
+        assignments = [_partition_kmeans(*task) for task in tasks]
+    else:
+        pool = mp.Pool(processes)
+        try:
+            assignments = pool.starmap(_partition_kmeans, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    busmap = pd.Series(index=network.buses.index, dtype=object)
+    for p, assign in zip(k.index, assignments):
+        busmap[(partition == p).values] = [p + '_' + str(a) for a in assign]
+
+    return busmap
+
+
+def warm_start_centres(network, weight, warm_start):
+    """ Cluster centres from a former clustering.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Container for all network components.
+
+    weight : pd.Series
+        Weight of each bus.
+
+    warm_start : pd.Series, dict, pd.DataFrame or str
+        Former busmap mapping bus_ids to clusters, cluster centres with
+        columns x and y, or a csv file holding one of both.
+
+    Returns
+    -------
+    centres : pd.DataFrame
+        Coordinates x and y indexed by cluster name.
+
+    busmap : pd.Series or None
+        The former busmap, if given.
+    """
+
+    if isinstance(warm_start, str):
+        warm_start = pd.read_csv(warm_start, index_col=0)
+        warm_start.index = warm_start.index.astype(str)
+        if not {'x', 'y'} <= set(warm_start.columns):
+            warm_start = warm_start.iloc[:, 0]
+
+    if isinstance(warm_start, pd.DataFrame):
+        return warm_start[['x', 'y']].astype(float), None
+
+    busmap = pd.Series(warm_start).astype(str)
+    buses = network.buses[['x', 'y']].assign(
+        cluster=busmap, weight=weight.reindex(network.buses.index,
+                                              fill_value=0) + 1e-9)
+    buses = buses[buses.cluster.notnull()]
+
+    centres = (buses[['x', 'y']].multiply(buses.weight, axis=0)
+               .groupby(buses.cluster).sum()
+               .divide(buses.weight.groupby(buses.cluster).sum(), axis=0))
+
+    return centres, busmap
+
+
+def busmap_by_warm_start(network, weight, n_clusters, warm_start,
+                         max_iter=300, tol=1e-4, random_state=None):
+    """ Refines a former clustering by weighted k-means instead of
+    starting from random centres, e.g. for slightly changed networks.
+
+    Clusters keep the names of the former clustering. If n_clusters
+    differs from the former number, the centres with the smallest weight
+    are dropped or new centres are added by k-means++ seeding.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Container for all network components.
+
+    weight : pd.Series
+        Weight of each bus.
+
+    n_clusters : int
+        Desired number of clusters.
+
+    warm_start : pd.Series, dict, pd.DataFrame or str
+        See :func:`warm_start_centres`.
+
+    max_iter : int
+        Maximal number of iterations.
+
+    tol : float
+        Tolerance of the shift of the centres relative to the variance of
+        the bus coordinates.
+
+    random_state : int or None
+        Seed for added centres.
+
+    Returns
+    -------
+    busmap : pd.Series
+        Maps bus_ids to cluster names.
+
+    changed : int or None
+        Number of buses assigned to another cluster than in the former
+        busmap, None if centres were given.
+    """
+
+    centres, former = warm_start_centres(network, weight, warm_start)
+
+    points = network.buses[['x', 'y']].values.astype(float)
+    w = weight.reindex(network.buses.index, fill_value=0).values.astype(
+        float) + 1e-9
+    random_state = np.random.RandomState(random_state)
+
+    if len(centres) > n_clusters:
+        _, assign = cKDTree(centres.values).query(points)
+        size = np.bincount(assign, weights=w, minlength=len(centres))
+        centres = centres.iloc[np.sort(np.argsort(-size)[:n_clusters])]
+
+    names = list(centres.index.astype(str))
+    names += ['new_%d' % i for i in range(len(names), n_clusters)]
+    centres = _kmeans_plusplus(points, w, n_clusters, random_state,
+                               centres.values)
+
+    assign, _, n_iter = _lloyd(points, w, centres, max_iter, tol)
+    busmap = pd.Series(np.array(names)[assign], index=network.buses.index)
+
+    changed = None
+    if former is not None:
+        common = busmap.index.intersection(former.index)
+        changed = int((busmap[common] != former[common]).sum())
+
+    print('k-means warm start: %d iterations, %s buses changed cluster'
+          % (n_iter, '-' if changed is None else changed))
+
+    return busmap, changed
+
+
+def kmean_clustering(network, n_clusters=10, load_cluster=False,
+                     line_length_factor=1.25,
+                     remove_stubs=False, use_reduced_coordinates=False,
+                     bus_weight_tocsv=None, bus_weight_fromcsv=None,
+                     n_init=10, max_iter=300, tol=1e-4,
+                     n_jobs=1, cache=None, warm_start=None, partition=None,
+                     processes=None):
+    """ Main function of the k-mean clustering approach. Maps an original
+    network to a new one with adjustable number of nodes and new coordinates.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Container for all network components.
+
+    n_clusters : int
+        Desired number of clusters.
+
+    load_cluster : boolean
+        Loads cluster coordinates from a former calculation.
+
+    line_length_factor : float
+        Factor to multiply the crow-flies distance between new buses in order
+        to get new line lengths.
+
+    remove_stubs: boolean
+        Removes stubs and stubby trees (i.e. sequentially reducing dead-ends).
+
+    use_reduced_coordinates: boolean
+        If True, do not average cluster coordinates, but take from busmap.
+
+    bus_weight_tocsv : str
+        Creates a bus weighting based on conventional generation and load
+        and save it to a csv file.
+
+    bus_weight_fromcsv : str
+        Loads a bus weighting from a csv file to apply it to the clustering
+        algorithm.
+
+    cache : :class:`etrago.tools.cache.LocalCache`, str or None
+        Local cache or its directory. The clustering is stored under a key
+        of the network, the bus weighting, n_clusters and all clustering
+        parameters, and loaded from there by later runs with the same
+        inputs instead of being recomputed.
+
+    warm_start : pd.Series, dict, pd.DataFrame, str or None
+        Former busmap or cluster centres, see :func:`warm_start_centres`.
+        If given, the clustering is refined from there by
+        :func:`busmap_by_warm_start` instead of n_init k-means runs.
+
+    partition : str, pd.Series or None
+        Column of network.buses, e.g. 'country_code', or pd.Series mapping
+        bus_ids to regions. If given, each region is clustered separately
+        in parallel by :func:`busmap_by_partition` and lines between
+        regions are kept.
+
+    processes : int or None
+        Number of processes of the partitioned clustering, None uses all
+        cores.
+
+    Returns
+    -------
+    clustering : pypsa.networkclustering.Clustering
+        Clustered network, busmap and linemaps.
+    """
+    print('start k-mean clustering')
+    if partition is not None and warm_start is not None:
+        raise Exception('warm_start can not be combined with partition.')
+    if isinstance(partition, str):
+        if partition not in network.buses.columns:
+            raise Exception('Buses have no column %s to partition the '
+                            'clustering, e.g. run geolocation_buses for '
+                            'country_code.' % partition)
+        partition = network.buses[partition]
+    weight = kmeans_preprocessing(network, bus_weight_tocsv=bus_weight_tocsv,
+                                  bus_weight_fromcsv=bus_weight_fromcsv)
+
+    # reduced coordinates of stubs are written to the network itself
+    if isinstance(cache, str):
+        cache = LocalCache(cache)
+    if cache is not None and not (remove_stubs and use_reduced_coordinates):
+        if isinstance(load_cluster, str):
+            with open(load_cluster, 'rb') as f:
+                load_cluster_hash = hashlib.sha1(f.read()).hexdigest()
+        else:
+            load_cluster_hash = load_cluster
+        if warm_start is None or isinstance(warm_start, str):
+            warm_start_hash = warm_start
+        else:
+            warm_start_hash = str(pd.util.hash_pandas_object(
+                pd.Series(warm_start) if isinstance(warm_start, dict)
+                else warm_start).sum())
+        key = LocalCache.key(
+            'kmeans', network_fingerprint(network),
+            str(pd.util.hash_pandas_object(weight.sort_index()).sum()),
+            n_clusters=n_clusters, load_cluster=load_cluster_hash,
+            line_length_factor=line_length_factor, remove_stubs=remove_stubs,
+            n_init=n_init, max_iter=max_iter, tol=tol,
+            warm_start=warm_start_hash,
+            partition=None if partition is None else str(
+                pd.util.hash_pandas_object(partition.sort_index()).sum()))
+        if key in cache:
+            print('Clustering loaded from %s' % cache)
+            return cache.load_clustering(key)
+    else:
+        cache = None
 
     # remove stubs
     if remove_stubs:
@@ -555,15 +1422,26 @@ def kmean_clustering(network, n_clusters=10, load_cluster=False,
         weight = weight.groupby(busmap.values).sum()
 
     # k-mean clustering
-    busmap = busmap_by_kmeans(
-        network,
-        bus_weightings=pd.Series(weight),
-        n_clusters=n_clusters,
-        load_cluster=load_cluster,
-        n_init=n_init,
-        max_iter=max_iter,
-        tol=tol,
-        n_jobs=n_jobs)
+    if warm_start is not None:
+        busmap = busmap_by_warm_start(
+            network, pd.Series(weight), n_clusters, warm_start,
+            max_iter=max_iter, tol=tol)[0]
+    elif partition is not None:
+        # stubs have been merged into the bus they are named after
+        busmap = busmap_by_partition(
+            network, pd.Series(weight), n_clusters,
+            partition.reindex(network.buses.index), processes=processes,
+            n_init=n_init, max_iter=max_iter, tol=tol)
+    else:
+        busmap = busmap_by_kmeans(
+            network,
+            bus_weightings=pd.Series(weight),
+            n_clusters=n_clusters,
+            load_cluster=load_cluster,
+            n_init=n_init,
+            max_iter=max_iter,
+            tol=tol,
+            n_jobs=n_jobs)
 
     # ToDo change function in order to use bus_strategies or similar
     network.generators['weight'] = network.generators['p_nom']
@@ -575,4 +1453,369 @@ def kmean_clustering(network, n_clusters=10, load_cluster=False,
         aggregate_generators_weighted=True,
         aggregate_one_ports=aggregate_one_ports)
 
+    if cache is not None:
+        cache.store_clustering(key, clustering)
+
     return clustering
+
+
+def _bisect(points, weights, n_init, max_iter, random_state):
+    """ Splits weighted points into two clusters by Lloyd's algorithm.
+
+    Returns the boolean membership of the second cluster and the weighted
+    sum of squared distances of both clusters, or None if the points can
+    not be split.
+    """
+
+    best = None
+    p = weights / weights.sum()
+
+    for _ in range(n_init):
+        # k-means++ initialisation
+        c0 = points[random_state.choice(len(points), p=p)]
+        d = weights * ((points - c0)**2).sum(axis=1)
+        if not d.sum() > 0:
+            return None
+        c1 = points[random_state.choice(len(points), p=d / d.sum())]
+        centres = np.array([c0, c1])
+
+        for _ in range(max_iter):
+            labels = (((points - centres[1])**2).sum(axis=1) <
+                      ((points - centres[0])**2).sum(axis=1))
+            new = np.array([
+                np.average(points[labels == i], axis=0,
+                           weights=weights[labels == i])
+                if (weights[labels == i].sum() > 0) else centres[i]
+                for i in (0, 1)])
+            if np.allclose(new, centres):
+                break
+            centres = new
+
+        sse = [(weights[labels == i] *
+                ((points[labels == i] - centres[i])**2).sum(axis=1)).sum()
+               for i in (0, 1)]
+        if best is None or sum(sse) < sum(best[1]):
+            best = (labels, sse)
+
+    if best[0].all() or not best[0].any():
+        return None
+
+    return best
+
+
+class ClusterTree():
+    """ Nested k-means tree of the buses of a network for clustering at
+    several spatial resolutions.
+
+    Starting from all buses, the cluster with the largest weighted sum of
+    squared distances to its centre is split in two by weighted k-means,
+    until max_clusters clusters exist. The busmap for any smaller number of
+    clusters is obtained by undoing the last splits, so clusters of
+    different resolutions are nested and named consistently.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Container for all network components.
+
+    weight : pd.Series
+        Weight of each bus, see :func:`bus_weighting`.
+
+    max_clusters : int
+        Finest resolution of the tree.
+
+    n_init : int
+        Number of initialisations of each split.
+
+    max_iter : int
+        Maximal number of iterations of each split.
+
+    random_state : int or None
+        Seed of the initialisation.
+    """
+
+    def __init__(self, network, weight, max_clusters, n_init=10,
+                 max_iter=300, random_state=None):
+
+        self.buses = network.buses.index
+        points = network.buses[['x', 'y']].values.astype(float)
+        weights = weight.reindex(self.buses, fill_value=0).values.astype(
+            float)
+        # buses without weight still have to be assigned
+        weights = np.maximum(weights, weights.max() * 1e-9 or 1.)
+        random_state = np.random.RandomState(random_state)
+
+        # node 0 is the root, split i creates nodes 2i+1 and 2i+2
+        self.parent = [-1]
+        self.step = [-1]
+        self.leaf = np.zeros(len(self.buses), dtype=int)
+
+        def sse(members):
+            centre = np.average(points[members], axis=0,
+                                weights=weights[members])
+            return (weights[members] *
+                    ((points[members] - centre)**2).sum(axis=1)).sum()
+
+        members = {0: np.arange(len(self.buses))}
+        heap = [(-sse(members[0]), 0)]
+
+        while heap and len(members) < max_clusters:
+            _, node = heapq.heappop(heap)
+            idx = members[node]
+            split = _bisect(points[idx], weights[idx], n_init, max_iter,
+                            random_state)
+            if split is None:
+                continue
+            labels, child_sse = split
+
+            step = len(self.step) // 2
+            for i, mask in enumerate([~labels, labels]):
+                child = len(self.parent)
+                self.parent.append(node)
+                self.step.append(step)
+                members[child] = idx[mask]
+                self.leaf[idx[mask]] = child
+                heapq.heappush(heap, (-child_sse[i], child))
+            del members[node]
+
+        self.parent = np.array(self.parent)
+        self.step = np.array(self.step)
+        self.max_clusters = len(members)
+
+    def busmap(self, n_clusters):
+        """ Busmap with n_clusters clusters, named by their tree node.
+
+        Parameters
+        ----------
+        n_clusters : int
+            Number of clusters, at most max_clusters.
+
+        Returns
+        -------
+        busmap : pd.Series
+            Maps bus_ids to cluster ids.
+        """
+
+        if n_clusters > self.max_clusters:
+            raise Exception('The tree has only %d clusters.'
+                            % self.max_clusters)
+
+        # nodes are created after their parents
+        rep = np.arange(len(self.parent))
+        for node in range(1, len(self.parent)):
+            if self.step[node] > n_clusters - 2:
+                rep[node] = rep[self.parent[node]]
+
+        return pd.Series(rep[self.leaf].astype(str), index=self.buses)
+
+
+def hierarchical_clustering(network, n_clusters, tree=None,
+                            line_length_factor=1.25, bus_weight_fromcsv=None,
+                            n_init=10, max_iter=300, random_state=None):
+    """ Clusters a network at several spatial resolutions from one
+    :class:`ClusterTree`, as alternative to :func:`kmean_clustering`.
+
+    Like kmean_clustering, the network is normalised to 380 kV in place.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Container for all network components.
+
+    n_clusters : int or list
+        Number or numbers of clusters.
+
+    tree : ClusterTree or None
+        Tree of a former call on the same network, None builds a new one up
+        to the largest n_clusters.
+
+    line_length_factor : float
+        Factor to multiply the crow-flies distance between new buses in order
+        to get new line lengths.
+
+    bus_weight_fromcsv : str
+        Loads a bus weighting from a csv file to apply it to the clustering
+        algorithm.
+
+    n_init, max_iter, random_state
+        Parameters of the splits of the tree.
+
+    Returns
+    -------
+    clustering : pypsa.networkclustering.Clustering or dict
+        Clustering for n_clusters, or dict of clusterings by the number of
+        clusters if n_clusters is a list.
+    """
+
+    ks = n_clusters if isinstance(n_clusters, (list, tuple)) else [n_clusters]
+
+    weight = kmeans_preprocessing(network,
+                                  bus_weight_fromcsv=bus_weight_fromcsv)
+    if tree is None:
+        tree = ClusterTree(network, weight, max(ks), n_init=n_init,
+                           max_iter=max_iter, random_state=random_state)
+
+    network.generators['weight'] = network.generators['p_nom']
+    aggregate_one_ports = components.one_port_components.copy()
+    aggregate_one_ports.discard('Generator')
+
+    clusterings = {}
+    for k in ks:
+        clusterings[k] = get_clustering_from_busmap(
+            network,
+            tree.busmap(k),
+            aggregate_generators_weighted=True,
+            aggregate_one_ports=aggregate_one_ports,
+            line_length_factor=line_length_factor)
+
+    if isinstance(n_clusters, (list, tuple)):
+        return clusterings
+    return clusterings[n_clusters]
+
+
+def clustering_metrics(network, busmap, weight):
+    """ Quality metrics of a busmap of a network prepared by
+    :func:`kmeans_preprocessing`.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Container for all network components, normalised to 380 kV.
+
+    busmap : pd.Series
+        Maps bus_ids to cluster ids.
+
+    weight : pd.Series
+        Weight of each bus.
+
+    Returns
+    -------
+    dict
+        inertia: weighted sum of squared distances of the buses to the
+        weighted centres of their clusters, as minimised by k-means.
+        electrical_distance: weighted mean reactance (Ohm at 380 kV) of the
+        shortest path from each bus to the bus nearest to its cluster
+        centre.
+        s_nom_lost, s_nom_lost_share: capacity of the lines within clusters,
+        which are removed by the clustering, in MVA and relative to all
+        lines.
+    """
+
+    buses = network.buses[['x', 'y']].assign(
+        cluster=busmap.reindex(network.buses.index).values,
+        weight=weight.reindex(network.buses.index, fill_value=0)
+        .astype(float).values)
+    buses = buses[buses.cluster.notnull()]
+
+    codes, clusters = pd.factorize(buses.cluster)
+    S = _incidence(codes, len(clusters), buses.weight.values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centres = S.dot(buses[['x', 'y']].values) / \
+            S.dot(np.ones(len(buses)))[:, None]
+    sq_dist = ((buses[['x', 'y']].values - centres[codes])**2).sum(axis=1)
+    inertia = (sq_dist * buses.weight.values).sum()
+
+    # bus nearest to the centre of each cluster
+    medoids = pd.Series(sq_dist, index=buses.index).groupby(codes).idxmin()
+
+    lines = network.lines
+    graph, nodes = line_graph(lines.assign(length=lines.x.abs()),
+                              buses.index)
+    dist = dijkstra(graph, directed=False,
+                    indices=nodes.get_indexer(medoids.values))
+    dist = dist[codes, nodes.get_indexer(buses.index)]
+    reachable = np.isfinite(dist)
+    electrical_distance = (
+        (dist[reachable] * buses.weight.values[reachable]).sum() /
+        buses.weight.values[reachable].sum())
+
+    internal = (lines.bus0.map(busmap) == lines.bus1.map(busmap)).values
+    s_nom_lost = lines.s_nom.values[internal].sum()
+
+    return {'inertia': inertia,
+            'electrical_distance': electrical_distance,
+            's_nom_lost': s_nom_lost,
+            's_nom_lost_share': s_nom_lost / lines.s_nom.sum()}
+
+
+# network, weight and options shared by the processes of kmeans_sweep
+_sweep = None
+
+
+def _init_sweep(data):
+    global _sweep
+    _sweep = data
+
+
+def _sweep_k(n_clusters):
+    network, weight, options = _sweep
+
+    t = time.time()
+    busmap = busmap_by_kmeans(network, bus_weightings=weight,
+                              n_clusters=n_clusters, n_jobs=1, **options)
+    metrics = clustering_metrics(network, busmap, weight)
+    metrics['time'] = time.time() - t
+    metrics['n_clusters'] = n_clusters
+
+    return metrics
+
+
+def kmeans_sweep(network, n_clusters, processes=None,
+                 bus_weight_fromcsv=None, n_init=10, max_iter=300,
+                 tol=1e-4):
+    """ Runs the k-mean clustering for several numbers of clusters in
+    parallel and evaluates the quality of each busmap, e.g. to choose the
+    smallest k that is accurate enough.
+
+    The network is prepared once by :func:`kmeans_preprocessing` on a copy
+    and shared by all processes.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Container for all network components. Not modified.
+
+    n_clusters : list
+        Numbers of clusters to evaluate.
+
+    processes : int or None
+        Number of processes, None uses all cores.
+
+    bus_weight_fromcsv : str
+        Loads a bus weighting from a csv file to apply it to the clustering
+        algorithm.
+
+    n_init, max_iter, tol
+        Parameters of the k-means algorithm.
+
+    Returns
+    -------
+    pd.DataFrame
+        Metrics of :func:`clustering_metrics` and the time of the k-means
+        algorithm in seconds, indexed by n_clusters.
+    """
+
+    network = network.copy()
+    weight = kmeans_preprocessing(network,
+                                  bus_weight_fromcsv=bus_weight_fromcsv)
+    data = (network, weight,
+            {'n_init': n_init, 'max_iter': max_iter, 'tol': tol})
+
+    try:
+        # forked processes use the network without copying it
+        context = mp.get_context('fork')
+        _init_sweep(data)
+        pool = context.Pool(processes)
+    except ValueError:
+        pool = mp.Pool(processes, initializer=_init_sweep, initargs=(data,))
+
+    try:
+        metrics = pool.map(_sweep_k, n_clusters)
+    finally:
+        pool.close()
+        pool.join()
+        _init_sweep(None)
+
+    return pd.DataFrame(metrics).set_index('n_clusters')[
+        ['inertia', 'electrical_distance', 's_nom_lost',
+         's_nom_lost_share', 'time']]
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016-2018  Flensburg University of Applied Sciences,
+# Europa-Universität Flensburg,
+# Centre for Sustainable Energy Systems,
+# DLR-Institute for Networked Energy Systems
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# File description
+"""
+backend.py
+
+Local copy of scenario data from the oedb in a SQLite or DuckDB file.
+
+A scenario is dumped once with :func:`dump_scenario`. Afterwards the file can
+be passed as `backend` to :class:`etrago.tools.io.NetworkScenario`,
+:func:`etrago.tools.io.extension`, :func:`etrago.tools.io.decommissioning`,
+:func:`etrago.cluster.networkclustering.busmap_from_psql` and
+:func:`etrago.tools.utilities.geolocation_buses`, or be set as 'local_db' in
+the arguments of :func:`etrago.appl.etrago`, to run without a connection to
+the oedb.
+
+Tables are named after their orm classes in egoio, e.g. 'EgoPfHvBus'.
+Arrays are stored as json, geometries as hex encoded WKB. DuckDB files
+(suffix .duckdb) require the package duckdb_engine.
+"""
+
+__copyright__ = ("Flensburg University of Applied Sciences, "
+                 "Europa-Universität Flensburg, "
+                 "Centre for Sustainable Energy Systems, "
+                 "DLR-Institute for Networked Energy Systems")
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__author__ = "ulfmueller, mariusves"
+
+import json
+import os
+from importlib import import_module
+
+import pandas as pd
+if 'READTHEDOCS' not in os.environ:
+    from geoalchemy2.elements import WKBElement
+    from sqlalchemy import create_engine, inspect, text
+
+#: str: Table holding the encoding of array, geometry and datetime columns
+COLUMNS_TABLE = '_etrago_columns'
+
+
+class LocalBackend():
+    """ Scenario data stored in a local SQLite or DuckDB file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the database file. Files with suffix '.duckdb' are opened
+        with DuckDB, all others with SQLite.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        dialect = 'duckdb' if path.endswith('.duckdb') else 'sqlite'
+        self.engine = create_engine('%s:///%s' % (dialect, path))
+
+    def __repr__(self):
+        return 'LocalBackend: %s' % self.path
+
+    def has_table(self, table):
+        return self.engine.has_table(table)
+
+    def _where(self, bind, table, filters):
+        """ WHERE clause and parameters matching filters. Filters that are
+        None match NULL, or are ignored if table has no such column. """
+
+        columns = [c['name'] for c in inspect(bind).get_columns(table)]
+        conditions = []
+        params = {}
+
+        for k, v in filters.items():
+            if v is not None:
+                conditions.append('"%s" = :%s' % (k, k))
+                params[k] = v
+            elif k in columns:
+                conditions.append('"%s" IS NULL' % k)
+
+        if not conditions:
+            return '', params
+
+        return ' WHERE ' + ' AND '.join(conditions), params
+
+    def _encodings(self, table):
+        """ Encoded columns of table as dict column -> (kind, srid). """
+
+        if not self.has_table(COLUMNS_TABLE):
+            return {}
+
+        df = pd.read_sql(
+            text('SELECT * FROM "%s" WHERE table_name = :table'
+                 % COLUMNS_TABLE),
+            self.engine, params={'table': table})
+
+        return {row.column_name: (row.kind, row.srid)
+                for row in df.itertuples()}
+
+    def read(self, table, columns=None, **filters):
+        """ Read rows of a table.
+
+        Parameters
+        ----------
+        table : str
+            Table name, i.e. the name of the orm class in egoio.
+        columns : list or None
+            Columns to read, None reads all columns.
+        **filters
+            Column values the rows have to match. Filters that are None
+            match NULL, like version in the model_draft.
+
+        Returns
+        -------
+        pd.DataFrame
+            Decoded table data. Empty if the table does not exist.
+        """
+
+        if not self.has_table(table):
+            print('Table %s does not exist in %s.' % (table, self.path))
+            return pd.DataFrame(columns=columns)
+
+        where, params = self._where(self.engine, table, filters)
+
+        sql = 'SELECT %s FROM "%s"' % (
+            '*' if columns is None
+            else ', '.join('"%s"' % col for col in columns),
+            table) + where
+
+        df = pd.read_sql(text(sql), self.engine, params=params)
+
+        for col, (kind, srid) in self._encodings(table).items():
+            if col not in df:
+                continue
+            if kind == 'array':
+                df[col] = df[col].map(
+                    lambda v: json.loads(v) if isinstance(v, str) else None)
+            elif kind == 'geometry':
+                df[col] = df[col].map(
+                    lambda v: WKBElement(bytes.fromhex(v), srid=int(srid))
+                    if isinstance(v, str) else None)
+            elif kind == 'datetime':
+                df[col] = pd.to_datetime(df[col])
+
+        return df
+
+    def write(self, table, df, **filters):
+        """ Write rows to a table. Existing rows matching filters are
+        replaced.
+
+        Parameters
+        ----------
+        table : str
+            Table name, i.e. the name of the orm class in egoio.
+        df : pd.DataFrame
+            Table data without index.
+        **filters
+            Column values of rows to replace. Filters that are None match
+            NULL.
+        """
+
+        df = df.copy()
+        encodings = []
+
+        for col in df.columns:
+            values = df[col].dropna()
+            if values.empty:
+                continue
+            first = values.iloc[0]
+            if isinstance(first, (list, tuple)):
+                df[col] = df[col].map(
+                    lambda v: json.dumps(list(v), default=float)
+                    if isinstance(v, (list, tuple)) else None)
+                encodings.append((table, col, 'array', None))
+            elif isinstance(first, WKBElement):
+                df[col] = df[col].map(
+                    lambda v: bytes(v.data).hex()
+                    if isinstance(v, WKBElement) else None)
+                encodings.append((table, col, 'geometry', first.srid))
+            elif isinstance(first, pd.Timestamp):
+                encodings.append((table, col, 'datetime', None))
+
+        with self.engine.begin() as conn:
+            if conn.dialect.has_table(conn, table):
+                where, params = self._where(conn, table, filters)
+                conn.execute(text('DELETE FROM "%s"' % table + where),
+                             **params)
+            df.to_sql(table, conn, if_exists='append', index=False)
+
+            if not encodings:
+                return
+            if conn.dialect.has_table(conn, COLUMNS_TABLE):
+                for _, col, _, _ in encodings:
+                    conn.execute(
+                        text('DELETE FROM "%s" WHERE table_name = :table '
+                             'AND column_name = :col' % COLUMNS_TABLE),
+                        table=table, col=col)
+            pd.DataFrame(encodings, columns=['table_name', 'column_name',
+                                             'kind', 'srid']).to_sql(
+                COLUMNS_TABLE, conn, if_exists='append', index=False)
+
+
+def dump_scenario(session, path, args, methods=('lopf', 'pf')):
+    """ Copy all data of a scenario needed by eTraGo from the oedb to a
+    local database file.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        Handles conversations with the oedb.
+    path : str
+        Path of the SQLite or DuckDB file. Data of other scenarios in an
+        existing file is kept.
+    args : dict
+        Settings from appl.py, using 'gridversion', 'scn_name',
+        'scn_extension' and 'scn_decommissioning'.
+    methods : tuple
+        Methods of config.json whose tables are copied.
+
+    Returns
+    -------
+    backend : LocalBackend
+        Local database holding the scenario.
+    """
+
+    from etrago.tools.io import load_config_file
+
+    backend = LocalBackend(path)
+    version = args['gridversion']
+    schema = 'grid' if version else 'model_draft'
+    pkg = import_module('egoio.db_tables.' + schema)
+    model_draft = import_module('egoio.db_tables.model_draft')
+
+    def dump(module, name, **filters):
+        ormclass = getattr(module, name, None)
+        if ormclass is None:
+            print('Warning: Relation %s does not exist.' % name)
+            return
+        query = session.query(ormclass)
+        for k, v in filters.items():
+            # like the oedb queries, None matches NULL
+            if v is not None:
+                query = query.filter(getattr(ormclass, k) == v)
+            elif hasattr(ormclass, k):
+                query = query.filter(getattr(ormclass, k).is_(None))
+        df = pd.read_sql(query.statement, session.bind)
+        backend.write(name, df, **filters)
+        print('Dumped %s (%d rows)' % (name, len(df)))
+
+    relations = set()
+    for method in methods:
+        for k, v in load_config_file()[method].items():
+            relations.add(k)
+            if isinstance(v, dict):
+                relations.update(v.keys())
+
+    if version:
+        prefix = 'EgoPfHv'
+    else:
+        prefix = 'EgoGridPfHv'
+
+    scenarios = [(prefix, args['scn_name'])]
+    for ext in args.get('scn_extension') or []:
+        scenarios.append((prefix + 'Extension', 'extension_' + ext))
+
+    for pre, scn_name in scenarios:
+        for name in relations:
+            dump(pkg, pre + name, scn_name=scn_name, version=version)
+        dump(pkg, pre + 'TempResolution', version=version)
+        dump(pkg, pre + 'Source', version=version)
+
+    if args.get('scn_decommissioning') is not None:
+        dump(pkg, prefix + 'ExtensionLine',
+             scn_name='decommissioning_' + args['scn_decommissioning'])
+
+    # busmaps of the ehv clustering, see appl.py for the naming
+    busmap_scn_name = args['scn_name']
+    if args.get('scn_extension'):
+        busmap_scn_name += '_ext_' + '_'.join(args['scn_extension'])
+    dump(model_draft, 'EgoGridPfHvBusmap', scn_name=busmap_scn_name,
+         version=version)
+
+    dump(model_draft, 'RenpassGisParameterRegion')
+
+    return backend
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016-2018  Flensburg University of Applied Sciences,
+# Europa-Universität Flensburg,
+# Centre for Sustainable Energy Systems,
+# DLR-Institute for Networked Energy Systems
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# File description
+"""
+cache.py
+
+Persistent local cache for data that is expensive to obtain from the oedb,
+e.g. the PyPSA network built by
+:meth:`etrago.tools.io.NetworkScenario.build_network`.
+
+Entries are stored as HDF5 files named by a hash of all inputs that define
+them. The cache directory is bounded in size, least recently used entries
+are evicted first.
+"""
+
+__copyright__ = ("Flensburg University of Applied Sciences, "
+                 "Europa-Universität Flensburg, "
+                 "Centre for Sustainable Energy Systems, "
+                 "DLR-Institute for Networked Energy Systems")
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__author__ = "ulfmueller, mariusves"
+
+import hashlib
+import json
+import os
+import warnings
+
+import pandas as pd
+import pypsa
+if 'READTHEDOCS' not in os.environ:
+    from geoalchemy2.elements import WKBElement
+
+#: int: Increase whenever the layout of cached files changes.
+CACHE_FORMAT = 1
+
+#: list: Attributes of a clustering stored besides the clustered network
+CLUSTERING_MAPS = ['busmap', 'linemap', 'linemap_positive',
+                   'linemap_negative']
+
+
+class LocalCache():
+    """ Size-bounded directory of cache files addressed by a key.
+
+    Parameters
+    ----------
+    directory : str
+        Path of the cache directory. Created if it does not exist.
+    max_size : int or None
+        Maximal size of all cache files in bytes. If exceeded, least
+        recently used files are removed. None disables the eviction.
+    suffix : str
+        File extension of cache files.
+    """
+
+    def __init__(self, directory, max_size=10 * 1024**3, suffix='.h5'):
+
+        self.directory = directory
+        self.max_size = max_size
+        self.suffix = suffix
+
+        os.makedirs(directory, exist_ok=True)
+
+    def __contains__(self, key):
+        return os.path.isfile(self.path(key))
+
+    def __repr__(self):
+        return 'LocalCache: %s' % self.directory
+
+    @staticmethod
+    def key(*args, **kwargs):
+        """ Hash all arguments to a cache key.
+
+        Arguments need to be serializable by json, other objects are
+        represented by their string representation.
+
+        Returns
+        -------
+        str
+            Hexadecimal digest.
+        """
+
+        content = json.dumps([CACHE_FORMAT, args, kwargs],
+                             sort_keys=True, default=str)
+
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """ Path of the cache file belonging to key. """
+
+        return os.path.join(self.directory, key + self.suffix)
+
+    def files(self):
+        """ Paths of all cache files, least recently used first. """
+
+        files = [os.path.join(self.directory, f)
+                 for f in os.listdir(self.directory)
+                 if f.endswith(self.suffix)]
+
+        return sorted(files, key=os.path.getmtime)
+
+    def touch(self, key):
+        """ Mark entry as recently used. """
+
+        os.utime(self.path(key), None)
+
+    def invalidate(self, key=None):
+        """ Remove one entry or, if key is None, all entries of the cache. """
+
+        files = self.files() if key is None else [self.path(key)]
+
+        for f in files:
+            if os.path.isfile(f):
+                os.remove(f)
+
+    def evict(self, keep=None):
+        """ Remove least recently used entries until the cache fits into
+        max_size.
+
+        Parameters
+        ----------
+        keep : str or None
+            Key of an entry that is never removed, e.g. the one just written.
+        """
+
+        if self.max_size is None:
+            return
+
+        files = self.files()
+        size = sum(os.path.getsize(f) for f in files)
+
+        for f in files:
+            if size <= self.max_size:
+                break
+            if keep is not None and f == self.path(keep):
+                continue
+            size -= os.path.getsize(f)
+            os.remove(f)
+            print('Removed %s from cache.' % os.path.basename(f))
+
+    def load_network(self, key):
+        """ Reconstruct a cached pypsa.Network. """
+
+        self.touch(key)
+
+        return network_from_hdf(self.path(key))
+
+    def store_network(self, key, network, components):
+        """ Write network to the cache and evict old entries. """
+
+        path = self.path(key)
+        try:
+            network_to_hdf(network, path, components)
+        except Exception:
+            # never leave a broken entry behind
+            if os.path.isfile(path):
+                os.remove(path)
+            raise
+
+        self.evict(keep=key)
+
+    def load_clustering(self, key):
+        """ Reconstruct a cached pypsa.networkclustering.Clustering. """
+
+        from pypsa.networkclustering import Clustering
+
+        self.touch(key)
+
+        path = self.path(key)
+        network = network_from_hdf(path)
+        with pd.HDFStore(path, mode='r') as store:
+            maps = [store[name] for name in CLUSTERING_MAPS]
+
+        return Clustering(network, *maps)
+
+    def store_clustering(self, key, clustering):
+        """ Write the clustered network, busmap and linemaps of a
+        clustering to the cache and evict old entries. """
+
+        components = [c.name for c in sorted(
+            clustering.network.iterate_components(),
+            key=lambda c: c.name != 'Bus')]
+
+        path = self.path(key)
+        try:
+            network_to_hdf(clustering.network, path, components)
+            with pd.HDFStore(path, mode='a', complevel=9,
+                             complib='blosc') as store:
+                for name in CLUSTERING_MAPS:
+                    store.put(name, getattr(clustering, name))
+        except Exception:
+            if os.path.isfile(path):
+                os.remove(path)
+            raise
+
+        self.evict(keep=key)
+
+    def load_frame(self, key):
+        """ Read a cached pd.DataFrame. """
+
+        self.touch(key)
+
+        return pd.read_hdf(self.path(key), 'frame')
+
+    def store_frame(self, key, df):
+        """ Write a pd.DataFrame to the cache and evict old entries. """
+
+        df.to_hdf(self.path(key), 'frame', mode='w', complevel=9,
+                  complib='blosc')
+
+        self.evict(keep=key)
+
+
+def network_fingerprint(network):
+    """ Hash of the static data and time series of all components.
+
+    Geometry columns are ignored, the order of rows and columns does not
+    matter.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Overall container of PyPSA
+
+    Returns
+    -------
+    str
+        Hexadecimal digest.
+    """
+
+    digest = hashlib.sha1()
+
+    def update(df, *names):
+        digest.update(json.dumps(
+            list(names) + [str(col) for col in getattr(df, 'columns', [])])
+            .encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(df, index=True).values
+                      .tobytes())
+
+    update(network.snapshot_weightings)
+
+    for c in sorted(network.iterate_components(), key=lambda c: c.name):
+        df = c.df.drop([col for col in ['geom', 'topo'] if col in c.df],
+                       axis=1)
+        update(df.sort_index().sort_index(axis=1), c.name)
+
+        for attr in sorted(c.pnl):
+            df = c.pnl[attr]
+            if not df.empty:
+                update(df.sort_index(axis=1), c.name, attr)
+
+    return digest.hexdigest()
+
+
+def picklable(df):
+    """ Copy of df whose geometry columns can be pickled.
+
+    Geometries queried by geoalchemy2 hold memoryviews, which cannot be
+    serialized.
+    """
+
+    df = df.copy()
+
+    for col in df.columns[df.dtypes == object]:
+        if df[col].map(lambda v: isinstance(v, WKBElement)).any():
+            df[col] = df[col].map(
+                lambda v: WKBElement(bytes(v.data), srid=v.srid,
+                                     extended=v.extended)
+                if isinstance(v, WKBElement) else v)
+
+    return df
+
+
+def network_to_hdf(network, path, components):
+    """ Write static data and time series of components to a HDF5 file.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Overall container of PyPSA
+    path : str
+        Path of the HDF5 file.
+    components : list
+        PyPSA component names, e.g. 'Bus', in the order of import.
+    """
+
+    with warnings.catch_warnings():
+        # object columns are pickled by pytables
+        warnings.simplefilter('ignore', pd.io.pytables.PerformanceWarning)
+
+        with pd.HDFStore(path, mode='w', complevel=9,
+                         complib='blosc') as store:
+
+            store.put('components', pd.Series(components))
+            store.put('snapshot_weightings', network.snapshot_weightings)
+
+            for comp in components:
+                store.put(comp, picklable(network.df(comp)))
+
+                for attr, df in network.pnl(comp).items():
+                    if not df.empty:
+                        store.put(comp + '_t/' + attr, df)
+
+
+def network_from_hdf(path):
+    """ Construct a pypsa.Network from a file written by network_to_hdf.
+
+    Parameters
+    ----------
+    path : str
+        Path of the HDF5 file.
+
+    Returns
+    -------
+    network : :class:`pypsa.Network
+        Overall container of PyPSA
+    """
+
+    network = pypsa.Network()
+
+    with pd.HDFStore(path, mode='r') as store:
+
+        weightings = store['snapshot_weightings']
+        network.set_snapshots(weightings.index)
+        network.snapshot_weightings = weightings
+
+        keys = store.keys()
+
+        for comp in store['components']:
+            network.import_components_from_dataframe(store[comp], comp)
+
+            prefix = '/' + comp + '_t/'
+            for key in keys:
+                if key.startswith(prefix):
+                    pypsa.io.import_series_from_dataframe(
+                        network, store[key], comp, key[len(prefix):])
+
+    return network
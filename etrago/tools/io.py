@@ -51,13 +51,22 @@ __author__ = "ulfmueller, mariusves"
 import pypsa
 from importlib import import_module
 import pandas as pd
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 import re
 import json
 import os
+import time
+from io import StringIO
 import numpy as np
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from weakref import WeakKeyDictionary
+from etrago.tools.cache import LocalCache
 if 'READTHEDOCS' not in os.environ:
-    from geoalchemy2.shape import to_shape
+    from etrago.tools.utilities import geom_to_coordinates
+    from scipy.spatial import cKDTree
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.orm import sessionmaker
     from sqlalchemy.orm.exc import NoResultFound
     from sqlalchemy import and_, func, or_
 
@@ -67,6 +76,14 @@ packagename = 'egoio.db_tables'
 temp_ormclass = 'TempResolution'
 carr_ormclass = 'Source'
 
+#: dict: Column names of result tables and their PyPSA attributes
+new_to_old_name = {'p_min_pu_fixed': 'p_min_pu',
+                   'p_max_pu_fixed': 'p_max_pu',
+                   'dispatch': 'former_dispatch',
+                   'current_type': 'carrier',
+                   'soc_cyclic': 'cyclic_state_of_charge',
+                   'soc_initial': 'state_of_charge_initial'}
+
 
 def load_config_file(filename='config.json'):
     dirname = os.path.dirname(__file__)
@@ -74,6 +91,43 @@ def load_config_file(filename='config.json'):
     return json.load(open(path), object_pairs_hook=OrderedDict)
 
 
+def stack_arrays(arrays, dtype='float64'):
+    """ Stack the values of an array column into one contiguous block.
+
+    Parameters
+    ----------
+    arrays : sequence
+        Sequence of lists or arrays, one per component. Missing values (None)
+        and shorter arrays are filled with NaN.
+    dtype : str or numpy.dtype
+        Data type of the result.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (length of the longest array, number of components).
+    """
+
+    lengths = [0 if a is None else len(a) for a in arrays]
+    n = max(lengths, default=0)
+
+    if n == 0:
+        # only missing values
+        return np.empty((0, len(lengths)), dtype=dtype)
+
+    if all(l == n for l in lengths):
+        block = np.array(list(arrays), dtype=dtype).reshape(len(lengths), n)
+    else:
+        block = np.full((len(lengths), n), np.nan, dtype=dtype)
+        for i, (a, l) in enumerate(zip(arrays, lengths)):
+            if l:
+                block[i, :l] = a
+
+    # one row per snapshot, one column per component. The transposed view
+    # matches pandas' internal column-major layout, so no copy is made.
+    return block.T
+
+
 class ScenarioBase():
     """ Base class to address the dynamic provision of orm classes representing
     powerflow components from egoio based on a configuration file
@@ -90,11 +144,14 @@ class ScenarioBase():
         Version number of data version control in grid schema of the oedb.
     prefix : str
         Common prefix of component orm classnames in egoio.
+    backend : :class:`etrago.tools.backend.LocalBackend` or None
+        Local database to read from instead of the oedb. Tables are
+        addressed by their orm class names.
     """
 
     def __init__(
         self, session, method='lopf', configpath='config.json', version=None,
-            prefix='EgoGridPfHv'):
+            prefix='EgoGridPfHv', backend=None):
 
         global packagename
         global temp_ormclass
@@ -106,6 +163,7 @@ class ScenarioBase():
         self.session = session
         self.version = version
         self._prefix = prefix
+        self.backend = backend
         #: module: Providing orm class definitions to oedb
         self._pkg = import_module(packagename + '.' + schema)
         #: dict: Container for orm classes corresponding to configuration file
@@ -156,17 +214,34 @@ class NetworkScenario(ScenarioBase):
         Last timestep.
     temp_id : int
         Nummer of temporal resolution.
+    cache : str, :class:`etrago.tools.cache.LocalCache` or None
+        Directory of a local cache for the built network. If set, a network
+        built once with the same settings is loaded from disk.
+    dtype : str or numpy.dtype
+        Data type of imported time series, 'float32' halves their memory.
+    max_workers : int
+        Number of tables queried concurrently by build_network. Each worker
+        uses its own session from the connection pool of the session's
+        engine. 1 queries all tables one after another.
     """
 
     def __init__(
         self, session, scn_name='Status Quo', method='lopf',
-            start_snapshot=1, end_snapshot=20, temp_id=1, **kwargs):
+            start_snapshot=1, end_snapshot=20, temp_id=1, cache=None,
+            dtype='float64', max_workers=1, **kwargs):
 
         self.scn_name = scn_name
         self.method = method
         self.start_snapshot = start_snapshot
         self.end_snapshot = end_snapshot
         self.temp_id = temp_id
+        self.dtype = np.dtype(dtype)
+        self.max_workers = max_workers
+
+        if isinstance(cache, str):
+            cache = LocalCache(cache)
+        #: LocalCache: Local cache of built networks
+        self.cache = cache
 
         super().__init__(session, **kwargs)
 
@@ -189,16 +264,22 @@ class NetworkScenario(ScenarioBase):
 
         try:
 
-            ormclass = self._mapped['TempResolution']
-            if self.version:
+            if self.backend is not None:
+                tr = self.backend.read(
+                    self._prefix + temp_ormclass,
+                    temp_id=self.temp_id, version=self.version).iloc[0]
+
+            elif self.version:
+                ormclass = self._mapped['TempResolution']
                 tr = self.session.query(ormclass).filter(
                     ormclass.temp_id == self.temp_id).filter(
                         ormclass.version == self.version).one()
             else:
+                ormclass = self._mapped['TempResolution']
                 tr = self.session.query(ormclass).filter(
                     ormclass.temp_id == self.temp_id).one()
 
-        except (KeyError, NoResultFound):
+        except (KeyError, IndexError, NoResultFound):
             print('temp_id %s does not exist.' % self.temp_id)
 
         timeindex = pd.DatetimeIndex(start=tr.start_time,
@@ -209,10 +290,15 @@ class NetworkScenario(ScenarioBase):
         """ pandas.tseries.index.DateTimeIndex :
                 Index of snapshots or timesteps. """
 
-    def id_to_source(self):
+    def id_to_source(self, session=None):
+
+        if self.backend is not None:
+            df = self.backend.read(self._prefix + carr_ormclass,
+                                   version=self.version)
+            return dict(zip(df.source_id, df.name))
 
         ormclass = self._mapped['Source']
-        query = self.session.query(ormclass)
+        query = (session or self.session).query(ormclass)
         
         if self.version:
             query = query.filter(ormclass.version == self.version)
@@ -220,13 +306,15 @@ class NetworkScenario(ScenarioBase):
         # TODO column naming in database
         return {k.source_id: k.name for k in query.all()}
 
-    def fetch_by_relname(self, name):
+    def fetch_by_relname(self, name, session=None):
         """ Construct DataFrame with component data from filtered table data.
 
         Parameters
         ----------
         name : str
             Component name.
+        session : sqlalchemy.orm.session.Session
+            Session of the query, by default the session of the scenario.
 
         Returns
         -------
@@ -234,34 +322,43 @@ class NetworkScenario(ScenarioBase):
             Component data.
         """
 
-        ormclass = self._mapped[name]
-        query = self.session.query(ormclass)
+        # TODO: Naming is not consistent. Change in database required.
+        index_col = ('trafo' if name == 'Transformer'
+                     else name.lower()) + '_id'
 
-        if name != carr_ormclass:
+        if self.backend is not None:
+            df = self.backend.read(
+                self._prefix + name,
+                scn_name=self.scn_name if name != carr_ormclass else None,
+                version=self.version).set_index(index_col)
 
-            query = query.filter(
-                ormclass.scn_name == self.scn_name)
+        else:
+            session = session or self.session
+            ormclass = self._mapped[name]
+            query = session.query(ormclass)
 
-        if self.version:
-            query = query.filter(ormclass.version == self.version)
+            if name != carr_ormclass:
 
-        # TODO: Naming is not consistent. Change in database required.
-        if name == 'Transformer':
-            name = 'Trafo'
+                query = query.filter(
+                    ormclass.scn_name == self.scn_name)
+
+            if self.version:
+                query = query.filter(ormclass.version == self.version)
+
+            df = pd.read_sql(query.statement,
+                             session.bind,
+                             index_col=index_col)
 
-        df = pd.read_sql(query.statement,
-                         self.session.bind,
-                         index_col=name.lower() + '_id')
         if name == 'Link':
             df['bus0'] = df.bus0.astype(int)
             df['bus1'] = df.bus1.astype(int)
 
         if 'source' in df:
-            df.source = df.source.map(self.id_to_source())
+            df.source = df.source.map(self.id_to_source(session))
 
         return df
 
-    def series_fetch_by_relname(self, name, column):
+    def series_fetch_by_relname(self, name, column, session=None):
         """ Construct DataFrame with component timeseries data from filtered
         table data.
 
@@ -271,6 +368,8 @@ class NetworkScenario(ScenarioBase):
             Component name.
         column : str
             Component field with timevarying data.
+        session : sqlalchemy.orm.session.Session
+            Session of the query, by default the session of the scenario.
 
         Returns
         -------
@@ -278,31 +377,47 @@ class NetworkScenario(ScenarioBase):
             Component data.
         """
 
-        ormclass = self._mapped[name]
-
         # TODO: This is implemented in a not very robust way.
         id_column = re.findall(r'[A-Z][^A-Z]*', name)[0] + '_' + 'id'
         id_column = id_column.lower()
 
-        query = self.session.query(
-            getattr(ormclass, id_column),
-            getattr(ormclass, column)[self.start_snapshot: self.end_snapshot].
-            label(column)).filter(and_(
-                ormclass.scn_name == self.scn_name,
-                ormclass.temp_id == self.temp_id))
+        if self.backend is not None:
+            df = self.backend.read(
+                self._prefix + name, columns=[id_column, column],
+                scn_name=self.scn_name, temp_id=self.temp_id,
+                version=self.version).set_index(id_column)
 
-        if self.version:
-            query = query.filter(ormclass.version == self.version)
+            # same as slicing the array column in postgres, which is 1-based
+            # and includes the upper bound
+            df[column] = df[column].map(
+                lambda a: a[self.start_snapshot - 1: self.end_snapshot]
+                if a is not None else None)
+
+        else:
+            session = session or self.session
+            ormclass = self._mapped[name]
+
+            query = session.query(
+                getattr(ormclass, id_column),
+                getattr(ormclass, column)[
+                    self.start_snapshot: self.end_snapshot].
+                label(column)).filter(and_(
+                    ormclass.scn_name == self.scn_name,
+                    ormclass.temp_id == self.temp_id))
+
+            if self.version:
+                query = query.filter(ormclass.version == self.version)
 
-        df = pd.io.sql.read_sql(query.statement,
-                                self.session.bind,
-                                columns=[column],
-                                index_col=id_column)
+            df = pd.io.sql.read_sql(query.statement,
+                                    session.bind,
+                                    columns=[column],
+                                    index_col=id_column)
 
         df.index = df.index.astype(str)
 
         # change of format to fit pypsa
-        df = df[column].apply(pd.Series).transpose()
+        df = pd.DataFrame(stack_arrays(df[column].values, dtype=self.dtype),
+                          columns=df.index)
 
         try:
             assert not df.empty
@@ -312,6 +427,54 @@ class NetworkScenario(ScenarioBase):
 
         return df
 
+    def fetch_all(self, requests):
+        """ Run several queries, concurrently if max_workers > 1.
+
+        Parameters
+        ----------
+        requests : list
+            Tuples of method name, e.g. 'fetch_by_relname', and its
+            arguments.
+
+        Returns
+        -------
+        list
+            Results in the order of requests.
+        """
+
+        if (self.max_workers <= 1 or self.backend is not None
+                or not isinstance(self.session.bind, Engine)):
+            return [getattr(self, method)(*args) for method, args in requests]
+
+        # one session per query, sharing the connection pool of the engine
+        Session = sessionmaker(bind=self.session.bind)
+
+        def run(request):
+            method, args = request
+            session = Session()
+            try:
+                return getattr(self, method)(*args, session=session)
+            finally:
+                session.close()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(run, requests))
+
+    def cache_key(self):
+        """ Key of the built network in the local cache. It covers all
+        settings the queried data depends on. """
+
+        return LocalCache.key(scn_name=self.scn_name,
+                              version=self.version,
+                              prefix=self._prefix,
+                              method=self.method,
+                              temp_id=self.temp_id,
+                              start_snapshot=self.start_snapshot,
+                              end_snapshot=self.end_snapshot,
+                              dtype=self.dtype.name,
+                              config=self.config,
+                              pypsa=pypsa.__version__)
+
     def build_network(self, network=None, *args, **kwargs):
         """  Core method to construct PyPSA Network object.
         """
@@ -320,6 +483,15 @@ class NetworkScenario(ScenarioBase):
         # replaced, when the oedb has a revision system in place, because
         # sometime this will break!!!
 
+        # only networks built from scratch are cached
+        key = None
+        if network is None and self.cache is not None:
+            key = self.cache_key()
+            if key in self.cache:
+                print('Load network from cache %s' % self.cache.path(key))
+                self.network = self.cache.load_network(key)
+                return self.network
+
         if network != None:
             network = network
 
@@ -354,12 +526,21 @@ class NetworkScenario(ScenarioBase):
                                {'soc_cyclic': 'cyclic_state_of_charge',
                                 'soc_initial': 'state_of_charge_initial'}}
 
+        # query all tables first, assemble the network in config order
+        requests = [('fetch_by_relname', (comp,)) for comp in self.config]
+        requests += [('series_fetch_by_relname', (comp_t, col))
+                     for comp_t_dict in self.config.values() if comp_t_dict
+                     for comp_t, columns in comp_t_dict.items()
+                     for col in columns]
+        requests.append(('fetch_by_relname', (carr_ormclass,)))
+        fetched = dict(zip(requests, self.fetch_all(requests)))
+
         for comp, comp_t_dict in self.config.items():
 
             # TODO: This is confusing, should be fixed in db
             pypsa_comp_name = 'StorageUnit' if comp == 'Storage' else comp
 
-            df = self.fetch_by_relname(comp)
+            df = fetched['fetch_by_relname', (comp,)]
 
             if comp in old_to_new_name:
 
@@ -374,7 +555,8 @@ class NetworkScenario(ScenarioBase):
 
                     for col in columns:
 
-                        df_series = self.series_fetch_by_relname(comp_t, col)
+                        df_series = fetched[
+                            'series_fetch_by_relname', (comp_t, col)]
 
                         # TODO: VMagPuSet is not implemented.
                         if timevarying_override and comp == 'Generator' \
@@ -397,7 +579,13 @@ class NetworkScenario(ScenarioBase):
 
         # populate carrier attribute in PyPSA network
         network.import_components_from_dataframe(
-            self.fetch_by_relname(carr_ormclass), 'Carrier')
+            fetched['fetch_by_relname', (carr_ormclass,)], 'Carrier')
+
+        if key is not None:
+            self.cache.store_network(
+                key, network,
+                ['StorageUnit' if comp == 'Storage' else comp
+                 for comp in self.config] + ['Carrier'])
 
         self.network = network
 
@@ -539,44 +727,32 @@ def results_to_oedb(session, network, args, grid='hv', safe_results=False):
 
     # get source_id
     sources = pd.read_sql(session.query(Source).statement, session.bind)
-    for gen in network.generators.index:
-        if network.generators.carrier[gen] not in sources.name.values:
-            new_source = Source()
-            new_source.source_id = session.query(
-                func.max(Source.source_id)).scalar()+1
-            new_source.name = network.generators.carrier[gen]
-            session.add(new_source)
-            session.commit()
-            sources = pd.read_sql(
-                    session.query(Source).statement, session.bind)
-        try:
-            old_source_id = int(
-                sources.source_id[
-                        sources.name == network.generators.carrier[gen]])
-            network.generators.set_value(gen, 'source', int(old_source_id))
-        except:
-            print(
-                'Source ' + network.generators.carrier[gen] + 
-                ' is not in the source table!')
-    for stor in network.storage_units.index:
-        if network.storage_units.carrier[stor] not in sources.name.values:
-            new_source = Source()
-            new_source.source_id = session.query(
-                func.max(Source.source_id)).scalar()+1
-            new_source.name = network.storage_units.carrier[stor]
-            session.add(new_source)
-            session.commit()
-            sources = pd.read_sql(
-                    session.query(Source).statement, session.bind)
-        try:
-            old_source_id = int(
-                sources.source_id[
-                        sources.name == network.storage_units.carrier[stor]])
-            network.storage_units.set_value(stor, 'source', int(old_source_id))
-        except:
-            print(
-                'Source ' + network.storage_units.carrier[stor] +
-                ' is not in the source table!')
+    carriers = pd.concat([network.generators.carrier,
+                          network.storage_units.carrier]).dropna().unique()
+    missing = sorted(set(carriers) - set(sources.name))
+
+    # insert all unknown carriers at once
+    if missing:
+        last_source_id = session.query(func.max(Source.source_id)).scalar()
+        first = 1 if last_source_id is None else last_source_id + 1
+        session.add_all([Source(source_id=first + i, name=name)
+                         for i, name in enumerate(missing)])
+        session.commit()
+        sources = pd.read_sql(session.query(Source).statement, session.bind)
+
+    source_ids = sources.drop_duplicates('name').set_index('name').source_id
+
+    # set the source only where the carrier is known, keep it otherwise
+    for df in (network.generators, network.storage_units):
+        source = df.carrier.map(source_ids)
+        known = source.notnull()
+        if not known.all():
+            print('Sources %s are not in the source table!' %
+                  ', '.join(map(str, df.carrier[~known].unique())))
+        if known.all() or 'source' not in df:
+            df['source'] = source.astype(int) if known.all() else source
+        else:
+            df.loc[known, 'source'] = source[known].astype(int)
 
     whereismyindex = {BusResult: network.buses.index,
                       LoadResult: network.loads.index,
@@ -604,92 +780,151 @@ def results_to_oedb(session, network, args, grid='hv', safe_results=False):
                      StorageTResult: network.storage_units_t,
                      GeneratorTResult: network.generators_t}
 
-    new_to_old_name = {'p_min_pu_fixed': 'p_min_pu',
-                       'p_max_pu_fixed': 'p_max_pu',
-                       'dispatch': 'former_dispatch',
-                       'current_type': 'carrier',
-                       'soc_cyclic': 'cyclic_state_of_charge',
-                       'soc_initial': 'state_of_charge_initial'}
-
     ormclasses = [BusResult, LoadResult, LineResult, TransformerResult, 
                   GeneratorResult, StorageResult, BusTResult, LoadTResult, 
                   LineTResult, TransformerTResult, GeneratorTResult, 
                   StorageTResult]
 
     for ormclass in ormclasses:
-        for index in whereismyindex[ormclass]:
-            myinstance = ormclass()
-            columns = ormclass.__table__.columns.keys()
-            columns.remove('result_id')
-            myinstance.result_id = new_res_id
-            for col in columns:
-                if '_id' in col:
-                    class_id_name = col
-                else:
-                    continue
-            setattr(myinstance, class_id_name, index)
-            columns.remove(class_id_name)
-
-            if str(ormclass)[:-2].endswith('T'):
-                for col in columns:
-                    if col == 'soc_set':
-                        try:
-                            setattr(myinstance, col, getattr(
-                                whereismydata[ormclass], 
-                                'state_of_charge_set')[index].tolist())
-                        except:
-                            pass
-                    else:
-                        try:
-                            setattr(myinstance, col, getattr(
-                                whereismydata[ormclass], col)[index].tolist())
-                        except:
-                            pass
-                session.add(myinstance)
-
-            else:
-                for col in columns:
-                    if col in new_to_old_name:
-                        if col == 'soc_cyclic':
-                            try:
-                                setattr(myinstance, col, bool(
-                                    whereismydata[ormclass].loc[index,
-                                                 new_to_old_name[col]]))
-                            except:
-                                pass
-                        elif 'Storage' in str(ormclass) and col == 'dispatch':
-                            try:
-                                setattr(myinstance, col,
-                                        whereismydata[ormclass].loc[index, col])
-                            except:
-                                pass
-                        else:
-                            try:
-                                setattr(
-                                    myinstance, col, whereismydata[ormclass].\
-                                    loc[index, new_to_old_name[col]])
-                            except:
-                                pass
-                    elif col in ['s_nom_extendable', 'p_nom_extendable']:
-                        try:
-                            setattr(myinstance, col, bool(
-                                whereismydata[ormclass].loc[index, col]))
-                        except:
-                            pass
-                    else:
-                        try:
-                            setattr(myinstance, col,
-                                    whereismydata[ormclass].loc[index, col])
-                        except:
-                            pass
-                session.add(myinstance)
+        x = time.time()
+        df = result_frame(ormclass.__table__,
+                          whereismydata[ormclass],
+                          whereismyindex[ormclass],
+                          timeseries=str(ormclass)[:-2].endswith('T'),
+                          storage='Storage' in str(ormclass))
+        df['result_id'] = new_res_id
+        bulk_insert(session, ormclass.__table__, df)
+        z = time.time() - x
+        print('%s: %d rows in %.1f s (%d rows/s)' % (
+            ormclass.__tablename__, len(df), z, len(df) / max(z, 1e-9)))
 
-        session.commit()
+    session.commit()
     print('Upload finished!')
 
     return
 
 
+def result_frame(table, data, index, timeseries=False, storage=False):
+    """ Arrange component data as rows of a result table.
+
+    Parameters
+    ----------
+    table : sqlalchemy.Table
+        Result table of the oedb.
+    data : pandas.DataFrame or dict
+        Static component data or dictionary of its time series.
+    index : pandas.Index
+        Component ids.
+    timeseries : bool
+        If True, data holds time series which are stored as arrays.
+    storage : bool
+        If True, the table belongs to storage units.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per component with the columns of table except result_id.
+        Attributes missing in data are None.
+    """
+
+    columns = table.columns.keys()
+    columns.remove('result_id')
+    # the component id is the last column containing '_id'
+    id_column = [col for col in columns if '_id' in col][-1]
+    columns.remove(id_column)
+
+    df = pd.DataFrame(index=index)
+    df[id_column] = index
+
+    for col in columns:
+        if timeseries:
+            attr = 'state_of_charge_set' if col == 'soc_set' else col
+            series = getattr(data, attr, None)
+            rows = {}
+            if isinstance(series, pd.DataFrame):
+                series = series.loc[:, series.columns.intersection(index)]
+                rows = dict(zip(series.columns, series.T.values.tolist()))
+            df[col] = [rows.get(i) for i in index]
+            continue
+
+        attr = col
+        if col in new_to_old_name and not (storage and col == 'dispatch'):
+            attr = new_to_old_name[col]
+
+        if attr not in data:
+            df[col] = None
+        elif col in ['soc_cyclic', 's_nom_extendable', 'p_nom_extendable']:
+            df[col] = data[attr].astype(bool)
+        else:
+            df[col] = data[attr]
+
+    return df
+
+
+def _copy_value(value):
+    """ Format value for PostgreSQL's COPY text format. """
+
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (list, tuple)):
+        return '{%s}' % ','.join('NULL' if v is None else str(v)
+                                 for v in value)
+
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def bulk_insert(session, table, df):
+    """ Insert all rows of df into table in one batch.
+
+    PostgreSQL's COPY is used if the connection supports it and all values
+    are plain numbers, strings or arrays. Otherwise the rows are inserted by
+    a single executemany.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        Handles conversations with the database.
+    table : sqlalchemy.Table
+        Target table.
+    df : pandas.DataFrame
+        Rows to insert, columns named as in table.
+    """
+
+    if df.empty:
+        return
+
+    # python objects instead of numpy scalars for the database driver
+    rows = df.astype(object).where(pd.notnull(df), None).values.tolist()
+
+    plain = (str, int, float, bool, list, tuple, type(None))
+    cursor = session.connection().connection.cursor()
+
+    if hasattr(cursor, 'copy_expert') and all(
+            isinstance(v, plain) for row in rows for v in row):
+        # the cursor belongs to the connection of the session's transaction
+
+        preparer = session.bind.dialect.identifier_preparer
+        statement = 'COPY %s (%s) FROM STDIN' % (
+            preparer.format_table(table),
+            ', '.join(preparer.quote(col) for col in df.columns))
+
+        buffer = StringIO()
+        for row in rows:
+            buffer.write('\t'.join(_copy_value(v) for v in row) + '\n')
+        buffer.seek(0)
+
+        cursor.copy_expert(statement, buffer)
+        cursor.close()
+
+    else:
+        cursor.close()
+        session.execute(table.insert(),
+                        [dict(zip(df.columns, row)) for row in rows])
+
+
 def run_sql_script(conn, scriptname='results_md2grid.sql'):
     """This function runs .sql scripts in the folder 'sql_scripts' """
 
@@ -727,6 +962,7 @@ def extension (network, session, version, scn_extension, start_snapshot,
           session : session-data
           overlay_scn_name : Name of the additional scenario (WITHOUT 'extension_')
           start_snapshot, end_snapshot: Simulation time
+          backend : Optional local database, see etrago.tools.backend
 
     Returns
     ------
@@ -746,7 +982,8 @@ def extension (network, session, version, scn_extension, start_snapshot,
                                method=kwargs.get('method', 'lopf'),
                                start_snapshot=start_snapshot,
                                end_snapshot=end_snapshot,
-                               scn_name='extension_' + scn_extension)
+                               scn_name='extension_' + scn_extension,
+                               backend=kwargs.get('backend'))
 
     network = scenario.build_network(network)
 
@@ -754,12 +991,10 @@ def extension (network, session, version, scn_extension, start_snapshot,
     network.links.loc[network.links.efficiency == 1.0, 'p_min_pu'] = -1
 
     # Set coordinates for new buses
-    extension_buses = network.buses[network.buses.scn_name ==
-                                    'extension_' + scn_extension]
-    for idx, row in extension_buses.iterrows():
-            wkt_geom = to_shape(row['geom'])
-            network.buses.loc[idx, 'x'] = wkt_geom.x
-            network.buses.loc[idx, 'y'] = wkt_geom.y
+    extension_buses = network.buses.scn_name == 'extension_' + scn_extension
+    x, y = geom_to_coordinates(network.buses.geom[extension_buses])
+    network.buses.loc[extension_buses, 'x'] = x
+    network.buses.loc[extension_buses, 'y'] = y
                
     return network
 
@@ -780,6 +1015,7 @@ def decommissioning(network, session, args, **kwargs):
         network : The existing network container (e.g. scenario 'NEP 2035')
         session : session-data
         overlay_scn_name : Name of the decommissioning scenario
+        backend : Optional local database, see etrago.tools.backend
 
 
     Returns
@@ -789,41 +1025,50 @@ def decommissioning(network, session, args, **kwargs):
     """  
 
     if args['gridversion'] == None:   
-        ormclass = getattr(import_module('egoio.db_tables.model_draft'),
-                           'EgoGridPfHvExtensionLine')
+        schema, ormclsname = 'model_draft', 'EgoGridPfHvExtensionLine'
     else:
-        ormclass = getattr(import_module('egoio.db_tables.grid'),
-                           'EgoPfHvExtensionLine')
+        schema, ormclsname = 'grid', 'EgoPfHvExtensionLine'
 
-    query = session.query(ormclass).filter(
-                        ormclass.scn_name == 'decommissioning_' + 
-                        args['scn_decommissioning'])
+    scn_name = 'decommissioning_' + args['scn_decommissioning']
+    backend = kwargs.get('backend')
 
-    df_decommisionning = pd.read_sql(query.statement,
-                         session.bind,
-                         index_col='line_id')
-    df_decommisionning.index = df_decommisionning.index.astype(str)
+    if backend is not None:
+        df_decommisionning = backend.read(
+            ormclsname, scn_name=scn_name).set_index('line_id')
+
+    else:
+        ormclass = getattr(import_module('egoio.db_tables.' + schema),
+                           ormclsname)
 
-    for idx, row in network.lines.iterrows():
-        if (row['s_nom_min'] !=0) & (
-            row['scn_name'] =='extension_' + args['scn_decommissioning']):
-                v_nom_dec = df_decommisionning['v_nom'][(
-                 df_decommisionning.project == row['project']) & (
-                         df_decommisionning.project_id == row['project_id'])]
+        query = session.query(ormclass).filter(ormclass.scn_name == scn_name)
 
-                if (v_nom_dec == 110).any():
-                    network.lines.s_nom_min[network.lines.index == idx]\
-                    = args['branch_capacity_factor']['HV'] *\
-                    network.lines.s_nom_min
+        df_decommisionning = pd.read_sql(query.statement,
+                             session.bind,
+                             index_col='line_id')
+    df_decommisionning.index = df_decommisionning.index.astype(str)
 
-                else:
-                    network.lines.s_nom_min[network.lines.index == idx] =\
-                    args['branch_capacity_factor']['eHV'] *\
-                    network.lines.s_nom_min
+    # Scale s_nom_min of extension lines replacing decommissioned lines by
+    # the capacity factor of the voltage level of the replaced lines
+    lines = network.lines
+    extension_lines = (lines.s_nom_min != 0) & (
+        lines.scn_name == 'extension_' + args['scn_decommissioning'])
+
+    if extension_lines.any():
+        replaces_hv = (df_decommisionning.v_nom == 110).groupby(
+            [df_decommisionning.project,
+             df_decommisionning.project_id]).any().rename('hv')
+        hv = lines.loc[extension_lines, ['project', 'project_id']].join(
+            replaces_hv, on=['project', 'project_id']).hv.fillna(False)
+        lines.loc[extension_lines, 's_nom_min'] *= np.where(
+            hv.astype(bool),
+            args['branch_capacity_factor']['HV'],
+            args['branch_capacity_factor']['eHV'])
 
     ### Drop decommissioning-lines from existing network
-    network.lines = network.lines[~network.lines.index.isin(
-            df_decommisionning.index)]
+    removed = network.lines.index.isin(df_decommisionning.index)
+    # kept for the update of the ehv busmap
+    network.decommissioned_lines = network.lines[removed]
+    network.lines = network.lines[~removed]
 
     return network
 
@@ -853,63 +1098,151 @@ def distance(x0, x1, y0, y1):
     return distance
 
 
-def calc_nearest_point(bus1, network):
-    """
-    Function that finds the geographical nearest point in a network from a given bus.
+class BusIndex():
+    """ Spatial index (KD-tree) over the coordinates of network.buses for
+    batched nearest neighbour queries.
 
+    The index is built from the buses at construction. Use
+    :func:`bus_index` to get an index that is rebuilt whenever the buses or
+    their coordinates changed.
 
     Parameters
-    -----
-        bus1:  float
-        id of bus
-        network: Pypsa network container
-        network including the comparable buses
+    ----------
+    network : :class:`pypsa.Network
+        Overall container of PyPSA
+    """
 
+    def __init__(self, network):
 
-    Returns
-    ------
-        bus0 : float
-        bus_id of nearest point
+        self.network = network
+        self.index = network.buses.index
+        self.coords = network.buses[['x', 'y']].values.astype(float)
+        self.checksum = _coords_checksum(self.coords)
+        self.tree = cKDTree(self.coords)
 
-    """
+    def is_valid(self):
+        """ True if the buses and their coordinates did not change since
+        the index was built. """
 
-    bus1_index = network.buses.index[network.buses.index == bus1]
+        buses = self.network.buses
 
-    forbidden_buses = np.append(
-        bus1_index.values, network.lines.bus1[
-                network.lines.bus0 == bus1].values)
+        if not (buses.index is self.index or
+                buses.index.equals(self.index)):
+            return False
 
-    forbidden_buses = np.append(
-        forbidden_buses, network.lines.bus0[network.lines.bus1 == bus1].values)
+        return self.checksum == _coords_checksum(
+            buses[['x', 'y']].values.astype(float))
 
-    forbidden_buses = np.append(
-        forbidden_buses, network.links.bus0[network.links.bus1 == bus1].values)
+    def neighbours(self, buses):
+        """ Pairs of buses directly connected by lines or links.
 
-    forbidden_buses = np.append(
-        forbidden_buses, network.links.bus1[network.links.bus0 == bus1].values)
+        Parameters
+        ----------
+        buses : list
+            Bus ids whose neighbours are collected.
 
-    x0 = network.buses.x[network.buses.index.isin(bus1_index)]
+        Returns
+        -------
+        set
+            Tuples of a bus out of buses and a bus connected to it.
+        """
+
+        pairs = set()
+        for c in [self.network.lines, self.network.links]:
+            for a, b in [('bus0', 'bus1'), ('bus1', 'bus0')]:
+                mask = c[a].isin(buses)
+                pairs.update(zip(c.loc[mask, a], c.loc[mask, b]))
 
-    y0 = network.buses.y[network.buses.index.isin(bus1_index)]
+        return pairs
 
-    comparable_buses = network.buses[~network.buses.index.isin(
-            forbidden_buses)]
+    def nearest(self, buses, exclude_connected=True):
+        """ Find the geographical nearest bus for each of the given buses.
+
+        Parameters
+        ----------
+        buses : list
+            Bus ids to find the nearest other bus for.
+        exclude_connected : bool
+            If True, buses directly connected by a line or link are skipped.
 
-    x1 = comparable_buses.x
+        Returns
+        -------
+        pandas.Series
+            Nearest bus id for each of the buses. Of several buses with the
+            same distance the one with the highest id is chosen.
+        """
 
-    y1 = comparable_buses.y
+        buses = pd.Index(buses)
+        positions = self.index.get_indexer(buses)
+        if (positions < 0).any():
+            raise KeyError('Buses not in the index: %s'
+                           % list(buses[positions < 0]))
+        excluded = self.neighbours(buses) if exclude_connected else set()
+        result = pd.Series(index=buses, dtype=object)
 
-    distance = (x1.values - x0.values)*(x1.values - x0.values) + \
-        (y1.values - y0.values)*(y1.values - y0.values)
+        todo = np.arange(len(buses))
+        degree = Counter(a for a, _ in excluded)
+        k = min(len(self.index), 2 + max(degree.values(), default=0))
+        points = self.coords[positions]
+
+        while len(todo):
+            distances, positions = self.tree.query(points[todo], k=k)
+            distances = distances.reshape(len(todo), k)
+            positions = positions.reshape(len(todo), k)
+            retry = []
+
+            for row, i in enumerate(todo):
+                bus = buses[i]
+                candidates = [
+                    (d, self.index[p]) for d, p in
+                    zip(distances[row], positions[row])
+                    if p < len(self.index) and self.index[p] != bus
+                    and (bus, self.index[p]) not in excluded]
+                # all ties of the minimal distance need to be found
+                complete = k == len(self.index) or (
+                    candidates and distances[row, -1] > candidates[0][0])
+                if not complete:
+                    retry.append(i)
+                elif candidates:
+                    d_min = candidates[0][0]
+                    result[bus] = max(c for d, c in candidates if d == d_min)
+
+            todo = np.array(retry, dtype=int)
+            k = min(len(self.index), 2 * k)
+
+        return result
+
+
+def _coords_checksum(coords):
+    return hashlib.sha1(np.ascontiguousarray(coords).tobytes()).hexdigest()
+
+
+#: WeakKeyDictionary: Spatial indices of networks, see bus_index
+_bus_indices = WeakKeyDictionary()
+
+
+def bus_index(network, rebuild=False):
+    """ Spatial index over the buses of network. It is reused as long as
+    the buses and their coordinates do not change.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Overall container of PyPSA
+    rebuild : bool
+        Rebuild the index in any case.
+
+    Returns
+    -------
+    BusIndex
+    """
 
-    min_distance = distance.min()
+    index = _bus_indices.get(network)
 
-    bus0 = comparable_buses[(((x1.values - x0.values)*(x1.values - x0.values
-        ) + (y1.values - y0.values)*(y1.values - y0.values)) == min_distance)]
-    bus0 = bus0.index[bus0.index == bus0.index.max()]
-    bus0 = ''.join(bus0.values)
+    if rebuild or index is None or not index.is_valid():
+        index = _bus_indices[network] = BusIndex(network)
 
-    return bus0
+    return index
 
 
 if __name__ == '__main__':
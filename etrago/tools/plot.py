@@ -36,7 +36,7 @@ import tilemapbase
 
 
 if 'READTHEDOCS' not in os.environ:
-    from geoalchemy2.shape import to_shape
+    from etrago.tools.utilities import geom_to_coordinates
 
 __copyright__ = ("Flensburg University of Applied Sciences, "
                  "Europa-Universität Flensburg, "
@@ -64,10 +64,9 @@ def add_coordinates(network):
     -------
     Altered PyPSA network container ready for plotting
     """
-    for idx, row in network.buses.iterrows():
-        wkt_geom = to_shape(row['geom'])
-        network.buses.loc[idx, 'x'] = wkt_geom.x
-        network.buses.loc[idx, 'y'] = wkt_geom.y
+    x, y = geom_to_coordinates(network.buses.geom)
+    network.buses['x'] = x
+    network.buses['y'] = y
 
     return network
 
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016-2018  Flensburg University of Applied Sciences,
+# Europa-Universität Flensburg,
+# Centre for Sustainable Energy Systems,
+# DLR-Institute for Networked Energy Systems
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# File description
+"""
+results.py
+
+Binary export of calculation results as compressed Parquet files, as an
+alternative to :func:`etrago.tools.utilities.results_to_csv`.
+
+A result folder contains
+
+* network.json: names of all files, the solver time and the settings,
+* snapshots.parquet: snapshots and their weightings,
+* <Component>.parquet: static data of each component, e.g. Generator.parquet,
+* <Component>-<attr>.parquet: time series, e.g. Generator-p.parquet.
+
+Time series are written in row groups of whole snapshot blocks, so that
+:class:`ResultsReader` can load single attributes and snapshot ranges
+without reading the whole folder. Requires the package pyarrow.
+
+:class:`ResultsWriter` runs any export, e.g. of each iteration of
+:func:`etrago.tools.utilities.iterate_lopf`, in a background thread.
+"""
+
+__copyright__ = ("Flensburg University of Applied Sciences, "
+                 "Europa-Universität Flensburg, "
+                 "Centre for Sustainable Energy Systems, "
+                 "DLR-Institute for Networked Energy Systems")
+__license__ = "GNU Affero General Public License Version 3 (AGPL-3.0)"
+__author__ = "ulfmueller, mariusves"
+
+import atexit
+import copy
+import json
+import os
+import queue
+import threading
+
+import pandas as pd
+import pypsa
+if 'READTHEDOCS' not in os.environ:
+    from geoalchemy2.elements import WKBElement
+
+#: int: Number of snapshots per row group of time series files
+ROW_GROUP_SIZE = 168
+
+
+def _parquet():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception('Parquet export requires the package pyarrow.')
+    return pyarrow, pyarrow.parquet
+
+
+def _write(df, path, compression, row_group_size=None):
+    pa, pq = _parquet()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, path, compression=compression,
+                   row_group_size=row_group_size)
+
+
+def results_to_parquet(network, args, path, compression='snappy',
+                       row_group_size=ROW_GROUP_SIZE):
+    """ Write the calculation results as Parquet files to a folder.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Overall container of PyPSA
+    args: dict
+        Contains calculation settings of appl.py
+    path: str
+        Folder of the result files, created if it does not exist.
+    compression : str
+        Parquet compression codec, e.g. 'snappy', 'gzip' or 'zstd'.
+    row_group_size : int
+        Number of snapshots per row group of time series files.
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    meta = {'name': network.name,
+            'components': [],
+            'series': {},
+            'geometries': {},
+            'row_group_size': row_group_size,
+            'args': args}
+    if hasattr(network, 'results'):
+        meta['time'] = network.results['Solver'].Time
+    if hasattr(network, 'objective'):
+        meta['objective'] = network.objective
+
+    snapshots = pd.DataFrame({'snapshot': network.snapshots,
+                              'weighting': network.snapshot_weightings.values})
+    _write(snapshots, os.path.join(path, 'snapshots.parquet'), compression)
+
+    # buses first, other components refer to them
+    for c in sorted(network.iterate_components(),
+                    key=lambda c: c.name != 'Bus'):
+        meta['components'].append(c.name)
+
+        df = c.df.copy()
+        df.index.name = 'name'
+        for col in df.columns[df.dtypes == object]:
+            geoms = df[col].map(lambda v: isinstance(v, WKBElement))
+            if geoms.any():
+                meta['geometries'].setdefault(c.name, {})[col] = \
+                    df[col][geoms].iloc[0].srid
+                df[col] = df[col].map(
+                    lambda v: bytes(v.data).hex()
+                    if isinstance(v, WKBElement) else None)
+        _write(df.reset_index(), os.path.join(path, c.name + '.parquet'),
+               compression)
+
+        meta['series'][c.name] = []
+        for attr, df in c.pnl.items():
+            if df.empty:
+                continue
+            meta['series'][c.name].append(attr)
+            # rows are aligned to snapshots.parquet
+            _write(df.reset_index(drop=True),
+                   os.path.join(path, '%s-%s.parquet' % (c.name, attr)),
+                   compression, row_group_size)
+
+    with open(os.path.join(path, 'network.json'), 'w') as fp:
+        json.dump(meta, fp, default=str)
+
+
+class ResultsReader():
+    """ Lazy access to results written by :func:`results_to_parquet`.
+
+    Files are only read when their data is requested.
+
+    Parameters
+    ----------
+    path : str
+        Result folder.
+
+    Examples
+    --------
+    >>> results = ResultsReader('results/lopf_iteration_4')
+    >>> p = results.series('Generator', 'p',
+    ...                    snapshots=slice('2011-01-01', '2011-01-07'))
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        with open(os.path.join(path, 'network.json')) as fp:
+            self.meta = json.load(fp)
+        self._snapshots = None
+
+    def __repr__(self):
+        return 'ResultsReader: %s' % self.path
+
+    @property
+    def components(self):
+        return self.meta['components']
+
+    @property
+    def snapshot_weightings(self):
+        """ Weightings of all snapshots as pd.Series. """
+
+        if self._snapshots is None:
+            df = self._read('snapshots.parquet')
+            self._snapshots = pd.Series(df.weighting.values,
+                                        index=pd.Index(df.snapshot))
+        return self._snapshots
+
+    @property
+    def snapshots(self):
+        return self.snapshot_weightings.index
+
+    def _read(self, filename, columns=None):
+        pa, pq = _parquet()
+        return pq.read_table(os.path.join(self.path, filename),
+                             columns=columns).to_pandas()
+
+    def attributes(self, component):
+        """ Names of the stored time series of a component. """
+
+        return self.meta['series'].get(component, [])
+
+    def static(self, component, columns=None):
+        """ Static data of a component.
+
+        Parameters
+        ----------
+        component : str
+            PyPSA component name, e.g. 'Generator'.
+        columns : list or None
+            Columns to read, None reads all columns.
+
+        Returns
+        -------
+        pd.DataFrame
+            Static data indexed by component names.
+        """
+
+        if columns is not None:
+            columns = ['name'] + list(columns)
+        df = self._read(component + '.parquet', columns).set_index('name')
+
+        for col, srid in self.meta['geometries'].get(component, {}).items():
+            if col in df:
+                df[col] = df[col].map(
+                    lambda v: WKBElement(bytes.fromhex(v), srid=srid)
+                    if isinstance(v, str) else None)
+
+        return df
+
+    def series(self, component, attr, snapshots=None, columns=None):
+        """ Time series of one attribute of a component.
+
+        Parameters
+        ----------
+        component : str
+            PyPSA component name, e.g. 'Generator'.
+        attr : str
+            Attribute, e.g. 'p'.
+        snapshots : slice or None
+            Range of snapshot labels, e.g. slice('2011-01-01', '2011-01-07').
+            Only the row groups covering it are read. None reads all
+            snapshots.
+        columns : list or None
+            Component names to read, None reads all.
+
+        Returns
+        -------
+        pd.DataFrame
+            Time series indexed by snapshots.
+        """
+
+        pa, pq = _parquet()
+        index = self.snapshots
+        start, stop = 0, len(index)
+        if snapshots is not None:
+            positions = index.slice_indexer(snapshots.start, snapshots.stop)
+            start, stop = positions.start or 0, positions.stop
+            if stop is None:
+                stop = len(index)
+
+        filename = os.path.join(self.path, '%s-%s.parquet' % (component, attr))
+        if columns is not None:
+            columns = [str(c) for c in columns]
+
+        if start == 0 and stop == len(index):
+            df = pq.read_table(filename, columns=columns).to_pandas()
+        else:
+            size = self.meta['row_group_size']
+            first = start // size
+            groups = range(first, max(first, (stop - 1) // size) + 1)
+            parquet = pq.ParquetFile(filename)
+            table = pa.concat_tables([
+                parquet.read_row_group(i, columns=columns) for i in groups
+                if i < parquet.num_row_groups])
+            df = table.to_pandas().iloc[start - first * size:
+                                        stop - first * size]
+
+        df.index = index[start:stop]
+        return df
+
+    def to_network(self, components=None):
+        """ Construct a pypsa.Network from the results.
+
+        Parameters
+        ----------
+        components : list or None
+            Components to import, None imports all.
+
+        Returns
+        -------
+        network : :class:`pypsa.Network
+            Overall container of PyPSA
+        """
+
+        network = pypsa.Network()
+        network.name = self.meta['name']
+        network.set_snapshots(self.snapshots)
+        network.snapshot_weightings = self.snapshot_weightings
+        if 'objective' in self.meta:
+            network.objective = self.meta['objective']
+
+        for comp in self.components:
+            if components is not None and comp not in components:
+                continue
+            df = self.static(comp)
+            if df.empty:
+                continue
+            network.import_components_from_dataframe(df, comp)
+            for attr in self.attributes(comp):
+                pypsa.io.import_series_from_dataframe(
+                    network, self.series(comp, attr), comp, attr)
+
+        return network
+
+
+def network_from_parquet(path, components=None):
+    """ Construct a pypsa.Network from a folder written by
+    :func:`results_to_parquet`.
+
+    Parameters
+    ----------
+    path : str
+        Result folder.
+    components : list or None
+        Components to import, None imports all.
+
+    Returns
+    -------
+    network : :class:`pypsa.Network
+        Overall container of PyPSA
+    """
+
+    return ResultsReader(path).to_network(components)
+
+
+def _copy_results(network):
+    """ Copy of network for the export, which is not changed by further
+    calculations on network.
+
+    Unlike :meth:`pypsa.Network.copy`, the components are not imported
+    again, only the static data and time series of each component are copied
+    as DataFrames. All other attributes, e.g. the solver results, are shared.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network`
+        Overall container of PyPSA
+
+    Returns
+    -------
+    :class:`pypsa.Network`
+    """
+
+    snapshot = copy.copy(network)
+    snapshot.snapshot_weightings = network.snapshot_weightings.copy()
+
+    for c in network.iterate_components():
+        setattr(snapshot, c.list_name, c.df.copy())
+        pnl = type(c.pnl)()
+        for attr, df in c.pnl.items():
+            pnl[attr] = df.copy()
+        setattr(snapshot, c.list_name + '_t', pnl)
+
+    return snapshot
+
+
+class ResultsWriter():
+    """ Export results in a background thread while the calculation goes on.
+
+    :meth:`put` copies the data of the network and returns as soon as the
+    copy is queued, the export itself runs in a worker thread. The export
+    holds the GIL for most of its time, so the gain is the overlap with the
+    solver, which runs in a separate process. The queue is bounded, so that
+    at most maxsize copies are held in memory. Pending exports are written
+    by :meth:`close`, which is also called at exit of the interpreter.
+
+    Parameters
+    ----------
+    export : callable
+        Called as export(network, \*args) for each queued network, e.g.
+        :func:`etrago.tools.utilities.export_results`.
+    maxsize : int
+        Maximal number of queued networks. :meth:`put` blocks if the queue
+        is full.
+    """
+
+    def __init__(self, export, maxsize=2):
+
+        self.export = export
+        self.queue = queue.Queue(maxsize)
+        self.errors = []
+        self.thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.export(*item)
+            except Exception as e:
+                print('Export of results failed: %s' % e)
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def put(self, network, *args):
+        """ Queue a copy of network, including its solver results, for
+        export. Raises errors of previous exports. """
+
+        if self.errors:
+            raise self.errors[0]
+
+        snapshot = _copy_results(network)
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+        self.queue.put((snapshot,) + args)
+
+    def close(self):
+        """ Wait until all queued exports are written and stop the worker.
+        Raises the first error of an export. """
+
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            atexit.unregister(self.close)
+
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]
@@ -31,6 +31,7 @@ import pypsa
 import json
 import logging
 import math
+from functools import partial
 
 geopandas = True
 try:
@@ -42,6 +43,8 @@ try:
 except:
     geopandas = False
 
+from etrago.tools.results import results_to_parquet, ResultsWriter
+
 logger = logging.getLogger(__name__)
 
 
@@ -98,7 +101,230 @@ def buses_grid_linked(network, voltage_level):
     return df.index
 
 
-def geolocation_buses(network, session):
+def _wkb_bytes(geom):
+    """ Raw WKB of a geometry given as WKBElement, bytes or hex string. """
+
+    data = getattr(geom, 'data', geom)
+    if isinstance(data, str):
+        return bytes.fromhex(data)
+    return bytes(data)
+
+
+def geom_to_coordinates(geom):
+    """ Decode point geometries to coordinate arrays in one pass.
+
+    Little endian (E)WKB points, as returned by the oedb, are decoded
+    directly from their binary representation with numpy. Other geometries
+    are decoded one by one using shapely.
+
+    Parameters
+    ----------
+    geom : :class:`pandas.Series
+        Point geometries as WKBElement, e.g. network.buses.geom
+
+    Returns
+    -------
+    x, y : numpy.ndarray
+        Coordinates of the points, NaN for missing geometries.
+    """
+
+    raw = [None if g is None or isinstance(g, float) else _wkb_bytes(g)
+           for g in geom]
+    x = np.full(len(raw), np.nan)
+    y = np.full(len(raw), np.nan)
+    decoded = np.zeros(len(raw), dtype=bool)
+
+    # 21 bytes: WKB point, 25 bytes: EWKB point including srid
+    for length in (21, 25):
+        pos = np.array([i for i, r in enumerate(raw)
+                        if r is not None and len(r) == length], dtype=int)
+        if not len(pos):
+            continue
+        block = np.frombuffer(b''.join(raw[i] for i in pos),
+                              dtype=np.uint8).reshape(len(pos), length)
+        geom_type = block[:, 1:5].copy().view('<u4').ravel()
+        # little endian, 2d point; upper bits flag the srid in EWKB
+        valid = (block[:, 0] == 1) & ((geom_type & 0xffff) == 1) & (
+            (geom_type >> 29 & 1) == (length == 25))
+        xy = block[valid, length - 16:].copy().view('<f8')
+        x[pos[valid]] = xy[:, 0]
+        y[pos[valid]] = xy[:, 1]
+        decoded[pos[valid]] = True
+
+    remaining = [i for i, r in enumerate(raw)
+                 if r is not None and not decoded[i]]
+    if remaining:
+        from shapely import wkb
+        for i in remaining:
+            point = wkb.loads(raw[i])
+            x[i], y[i] = point.x, point.y
+
+    return x, y
+
+
+class GeometryStore():
+    """ Geometry columns of network components kept on disk instead of in
+    memory.
+
+    Columns are pickled per component and only loaded again when they are
+    requested by :meth:`get` or put back by :meth:`restore`.
+
+    Parameters
+    ----------
+    directory : str or None
+        Directory of the pickled columns. None creates a temporary
+        directory.
+    """
+
+    def __init__(self, directory=None):
+
+        if directory is None:
+            import tempfile
+            directory = tempfile.mkdtemp(prefix='etrago_geometries_')
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.columns = {}
+
+    def __repr__(self):
+        return 'GeometryStore: %s' % self.directory
+
+    def path(self, component, column):
+        return os.path.join(self.directory,
+                            '%s_%s.pkl' % (component, column))
+
+    def put(self, component, df):
+        """ Move geometry columns of a component from df to the store. """
+
+        from etrago.tools.cache import picklable
+
+        columns = [col for col in ['geom', 'topo'] if col in df.columns]
+        for col in columns:
+            picklable(df[[col]])[col].to_pickle(self.path(component, col))
+        self.columns[component] = columns
+
+        return df.drop(columns, axis=1)
+
+    def get(self, component, column):
+        """ Load one geometry column as pd.Series indexed like the
+        component. """
+
+        return pd.read_pickle(self.path(component, column))
+
+    def restore(self, network):
+        """ Put all stored geometry columns back into network. Components
+        that were removed or renamed in the meantime get NaN. """
+
+        for component, columns in self.columns.items():
+            df = network.df(component)
+            for col in columns:
+                df[col] = self.get(component, col).reindex(df.index)
+
+
+def network_memory_usage(network):
+    """ Memory used by static data and time series of each component.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Overall container of PyPSA
+
+    Returns
+    -------
+    pd.Series
+        Bytes per component name.
+    """
+
+    usage = {}
+    for c in network.iterate_components():
+        usage[c.name] = c.df.memory_usage(deep=True).sum() + sum(
+            df.memory_usage(deep=True).sum() for df in c.pnl.values())
+
+    return pd.Series(usage)
+
+
+def compact_network(network, float32=True, categories=True,
+                    geometries=None, rtol=1e-6):
+    """ Reduce the memory used by a network loaded from the oedb.
+
+    * time series are converted to float32 if this does not change any
+      value by more than rtol,
+    * text columns that are not PyPSA attributes (e.g. scn_name) and hold
+      few distinct values become categoricals,
+    * geometry columns (geom, topo) are moved to a
+      :class:`GeometryStore`, which is set as network.geometries.
+
+    Bus names and carriers stay strings, as they are extended and grouped
+    by clustering and disaggregation.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Overall container of PyPSA
+    float32 : bool
+        Convert time series to float32.
+    categories : bool
+        Convert repetitive text columns to categoricals.
+    geometries : str, GeometryStore or None
+        Store or directory for geometry columns, None for a temporary
+        directory. False keeps geometries in memory.
+    rtol : float
+        Maximal relative deviation accepted for float32 time series.
+
+    Returns
+    -------
+    report : pd.DataFrame
+        Memory before and after in MB per component.
+    """
+
+    before = network_memory_usage(network)
+
+    if geometries is not False and not isinstance(geometries, GeometryStore):
+        geometries = GeometryStore(geometries)
+
+    for c in network.iterate_components():
+
+        if geometries is not False:
+            df = geometries.put(c.name, c.df)
+            setattr(network, c.list_name, df)
+
+        if categories:
+            df = network.df(c.name)
+            for col in df.columns:
+                if (col in c.attrs.index or col in ['geom', 'topo'] or
+                        not pd.api.types.is_string_dtype(df[col])):
+                    continue
+                values = df[col].dropna()
+                if (len(values) > 1 and values.map(type).eq(str).all() and
+                        values.nunique() <= len(values) / 2):
+                    df[col] = df[col].astype('category')
+
+        if float32:
+            for attr, df in c.pnl.items():
+                if df.empty or not (df.dtypes == np.float64).all():
+                    continue
+                values = df.values
+                compact = values.astype(np.float32)
+                with np.errstate(over='ignore', invalid='ignore'):
+                    if np.allclose(values, compact, rtol=rtol, atol=0,
+                                   equal_nan=True):
+                        c.pnl[attr] = df.astype(np.float32)
+
+    if geometries is not False:
+        network.geometries = geometries
+
+    report = pd.DataFrame({'before': before,
+                           'after': network_memory_usage(network)}) / 1024**2
+    report = report[report.before > 0]
+    for name, row in report.iterrows():
+        print('%s: %.1f MB -> %.1f MB' % (name, row.before, row.after))
+    print('Network memory: %.1f MB -> %.1f MB' % tuple(report.sum()))
+
+    return report
+
+
+def geolocation_buses(network, session, backend=None):
     """
      If geopandas is installed:
      Use Geometries of buses x/y(lon/lat) and Polygons
@@ -114,6 +340,8 @@ def geolocation_buses(network, session):
          eTraGo network object compiled by: meth: `etrago.appl.etrago`
      session: : sqlalchemy: `sqlalchemy.orm.session.Session < orm/session_basics.html >`
          SQLAlchemy session to the OEDB
+     backend: : class: `etrago.tools.backend.LocalBackend`
+         Optional local database to read the regions from instead of the OEDB
 
     """
     if geopandas:
@@ -126,18 +354,23 @@ def geolocation_buses(network, session):
         region_id = ['DE', 'DK', 'FR', 'BE', 'LU', 'AT',
                      'NO', 'PL', 'CH', 'CZ', 'SE', 'NL']
 
-        query = session.query(RenpassGISRegion.gid,
-                              RenpassGISRegion.u_region_id,
-                              RenpassGISRegion.stat_level,
-                              RenpassGISRegion.geom,
-                              RenpassGISRegion.geom_point)
+        columns = ['gid', 'u_region_id', 'stat_level', 'geom', 'geom_point']
+
+        if backend is not None:
+            rows = backend.read('RenpassGisParameterRegion', columns=columns)
+            rows = rows[rows.u_region_id.isin(region_id)].itertuples(
+                index=False)
+        else:
+            query = session.query(*[getattr(RenpassGISRegion, col)
+                                    for col in columns])
+            rows = query.filter(RenpassGISRegion.u_region_id.
+                                in_(region_id)).all()
 
         # get regions by query and filter
         Regions = [(gid, u_region_id, stat_level, geoalchemy2.shape.to_shape(
                  geom), geoalchemy2.shape.to_shape(geom_point))
                  for gid, u_region_id, stat_level,
-                geom, geom_point in query.filter(RenpassGISRegion.u_region_id.
-                                                 in_(region_id)).all()]
+                geom, geom_point in rows]
 
         crs = {'init': 'epsg:4326'}
         # transform lon lat to shapely Points and create GeoDataFrame
@@ -158,7 +391,8 @@ def geolocation_buses(network, session):
         network.buses['country_code'] = busC['country']
         network.buses.country_code[network.buses.country_code.isnull()] = 'DE'
         # close session 
-        session.close()
+        if session is not None:
+            session.close()
 
     else:
 
@@ -608,7 +842,24 @@ def _enumerate_row(row):
     return row
 
 
-def results_to_csv(network, args, path):
+def count_csv_export(args):
+    """ Count an export of results_to_csv and write the settings to
+    args.json in the folder 'csv_export' with the first one.
+
+    Parameters
+    ----------
+    args: dict
+        Contains calculation settings of appl.py
+
+    """
+    results_to_csv.counter += 1
+    if results_to_csv.counter == 1 and args['csv_export'] != False:
+        os.makedirs(args['csv_export'], exist_ok=True)
+        with open(os.path.join(args['csv_export'], 'args.json'), 'w') as fp:
+            json.dump(args, fp)
+
+
+def results_to_csv(network, args, path, count=True):
     """ Function the writes the calaculation results
     in csv-files in the desired directory. 
 
@@ -620,9 +871,13 @@ def results_to_csv(network, args, path):
         Contains calculation settings of appl.py
     path: str
         Choose path for csv-files
+    count: bool
+        Call :func:`count_csv_export`. Set False if the export is
+        counted by the calling thread, e.g. in :func:`iterate_lopf`.
 
     """
-    results_to_csv.counter += 1
+    if count:
+        count_csv_export(args)
     if path == False:
         return None
 
@@ -635,10 +890,6 @@ def results_to_csv(network, args, path):
     data = data.apply(_enumerate_row, axis=1)
     data.to_csv(os.path.join(path, 'network.csv'), index=False)
 
-    if results_to_csv.counter == 1:
-        with open(os.path.join(args['csv_export'], 'args.json'), 'w') as fp:
-            json.dump(args, fp)
-
     if hasattr(network, 'Z'):
         file = [i for i in os.listdir(
             path.strip('0123456789')) if i == 'Z.csv']
@@ -650,6 +901,31 @@ def results_to_csv(network, args, path):
     return
 
 
+def export_results(network, args, name, count=True):
+    """ Write the calculation results to the folders set as 'csv_export'
+    and 'parquet_export' in args.
+
+    Parameters
+    ----------
+    network : :class:`pypsa.Network
+        Overall container of PyPSA
+    args: dict
+        Contains calculation settings of appl.py
+    name: str
+        Subfolder of the results, e.g. 'lopf_iteration_1'
+    count: bool
+        Count the csv export, see :func:`results_to_csv`
+
+    """
+    if args['csv_export'] != False:
+        results_to_csv(network, args, args['csv_export'] + '/' + name,
+                       count=count)
+
+    if args.get('parquet_export'):
+        results_to_parquet(network, args, os.path.join(
+            args['parquet_export'], name))
+
+
 def parallelisation(network, args, group_size, extra_functionality=None):
 
     """
@@ -883,9 +1159,9 @@ def pf_post_lopf(network, args, add_foreign_lopf, q_allocation, calc_losses):
 
     network = distribute_q(network, allocation=q_allocation)
     
+    export_results(network, args, 'pf_post_lopf')
     if args['csv_export'] != False:
             path=args['csv_export']+ '/pf_post_lopf'
-            results_to_csv(network, args, path)
             pf_solve.to_csv(os.path.join(path, 'pf_solution.csv'), index=True)
     
     return network
@@ -1841,6 +2117,13 @@ def iterate_lopf(network, args, extra_functionality, method={'n_iter':4},
 
     """
     results_to_csv.counter=0
+
+    # export results in the background while the next lopf is solved,
+    # the exports are counted here to keep the counter in this thread
+    if args['csv_export'] != False or args.get('parquet_export'):
+        writer = ResultsWriter(partial(export_results, count=False))
+    else:
+        writer = None
     
     # if network is extendable, iterate lopf 
     # to include changes of electrical parameters
@@ -1883,9 +2166,9 @@ def iterate_lopf(network, args, extra_functionality, method={'n_iter':4},
                     raise  Exception('LOPF '+ str(i) + ' not solved.')
 
                 print("Time for LOPF [min]:", round(z, 2))
-                if args['csv_export'] != False:
-                    path=args['csv_export'] + '/lopf_iteration_'+ str(i)
-                    results_to_csv(network, args, path)
+                if writer:
+                    count_csv_export(args)
+                    writer.put(network, args, 'lopf_iteration_' + str(i))
 
                 if i < n_iter:
                     l_snom_pre, t_snom_pre = \
@@ -1942,9 +2225,9 @@ def iterate_lopf(network, args, extra_functionality, method={'n_iter':4},
 
                 i += 1
 
-                if args['csv_export'] != False:
-                    path=args['csv_export'] + '/lopf_iteration_'+ str(i)
-                    results_to_csv(network, args, path)
+                if writer:
+                    count_csv_export(args)
+                    writer.put(network, args, 'lopf_iteration_' + str(i))
                     
                 if abs(pre-network.objective) <=diff_obj:
                     print('Threshold reached after ' + str(i) + ' iterations.')
@@ -1962,10 +2245,11 @@ def iterate_lopf(network, args, extra_functionality, method={'n_iter':4},
             z = (y - x) / 60
             print("Time for LOPF [min]:", round(z, 2))
         
-            if args['csv_export'] != False:
-                path=args['csv_export']+ '/lopf'
-                results_to_csv(network, args, path)
-            
+            export_results(network, args, 'lopf')
+
+    if writer:
+        writer.close()
+
     return network
             
 
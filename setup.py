@@ -33,7 +33,8 @@ setup(
                       'shapely',
                       'oedialect',
                       'pyproj == 2.0.2',
-                      'tilemapbase == 0.4.5'],
+                      'tilemapbase == 0.4.5',
+                      'tables'],
     dependency_links=[
         ('git+https://git@github.com/openego/PyPSA.git'
          '@master#egg=pypsa-0.11.0fork')],